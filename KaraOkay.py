@@ -17,15 +17,521 @@
 
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
-import sys, random, math, re, pygame, numpy, argparse
+import sys, random, math, re, argparse, importlib.util
+import subprocess, tempfile, glob, time
+import threading, queue, struct, pickle, enum, contextlib, json, signal, socket
+from collections import OrderedDict, namedtuple
 from os.path import abspath, realpath, isfile
-from moviepy.editor import *
+
+def lazyImport(name):
+  """
+    Import a module when it's first used. Validating a file or printing
+    the help doesn't need pygame and numpy, and they take a while to
+    load. Once loaded, the module is a regular one.
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  spec = importlib.util.find_spec(name)
+  spec.loader = importlib.util.LazyLoader(spec.loader)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  spec.loader.exec_module(module)
+  return module
+
+pygame = lazyImport("pygame")
+numpy = lazyImport("numpy")
+multiprocessing = lazyImport("multiprocessing")
+hashlib = lazyImport("hashlib")
+sqlite3 = lazyImport("sqlite3")
+
+# Seconds: 1, 10, 1.1, 10.99, Minutes: 1:00, 1:01.0
+tsRegex = r'(?:(\d+):)?(\d?\d(?:\.\d\d?)?)'
+durationPattern = re.compile(r"#\s+Duration:\s" + tsRegex)
+cardPattern = re.compile(r"--\s*" + tsRegex + r"\s*-\s*" + tsRegex)
+bracketPattern = re.compile(r"\[([^\[\]]*)\]")
+timestampPattern = re.compile(tsRegex)
+
+# Audio codecs which may be copied into a movie, by its file extension.
+copyableAudio = {
+  ".mp4": {"aac", "mp3", "alac", "ac3", "eac3"},
+  ".m4v": {"aac", "mp3", "alac", "ac3", "eac3"},
+  ".mov": {"aac", "mp3", "alac", "ac3", "eac3", "pcm_s16le", "pcm_s24le"},
+  ".mkv": {"aac", "mp3", "alac", "ac3", "eac3", "flac", "opus", "vorbis", "pcm_s16le", "pcm_s24le"}
+}
+
+# kind is "duration", "card", "text" or "timestamp". line and col are
+# where the token starts in the file, counting from 1.
+Token = namedtuple("Token", "kind value line col")
 
 class ParserError(Exception):
-  pass
-  
+  """
+    Raised for invalid kok files, with the line and, if known, the
+    column the error was found in.
+  """
+  def __init__(self, line, message, col = None):
+    Exception.__init__(self, line, message, col)
+    self.line = line
+    self.message = message
+    self.col = col
+
+  def __str__(self):
+    if self.col:
+      return "%d, column %d: %s" % (self.line, self.col, self.message)
+    return "%d: %s" % (self.line, self.message)
+
+class Display(enum.IntEnum):
+  """
+    How a line is shown: plain lyrics, lyrics with a cue counting down
+    to the first word, a peek at the next card or a pause bar.
+  """
+  REGULAR = 0
+  CUE = 1
+  PEEK = 2
+  PAUSE = 3
+
+class Card:
+  """
+    A card of the kok file, its lines given as lists of "text" and
+    "timestamp" tokens. The gaps to the cards around it and when and how
+    to show it are filled in by the layout step.
+  """
+  __slots__ = ("start", "end", "lines", "pre_gap", "post_gap", "show", "hide", "display", "peek")
+
+  def __init__(self, start, end, lines = None):
+    self.start = start
+    self.end = end
+    self.lines = [] if lines is None else lines
+    self.pre_gap = 0
+    self.post_gap = 0
+    self.show = start
+    self.hide = end
+    self.display = Display.REGULAR
+    self.peek = False
+
+class Part:
+  """
+    The text of a line between two timestamps, highlighted from start to
+    end.
+  """
+  __slots__ = ("text", "start", "end")
+
+  def __init__(self, text, start, end):
+    self.text = text
+    self.start = start
+    self.end = end
+
+class Line:
+  """
+    Anything shown in a slot from show to hide. Lines of lyrics are
+    highlighted from start to end, part by part if there are parts, and
+    know the index of their card. Peeks only have a text, pause bars
+    neither text nor timing.
+  """
+  __slots__ = ("display", "slot", "show", "hide", "text", "start", "end", "parts", "card")
+
+  def __init__(self, display, slot, show, hide, text = None, start = None, end = None, parts = None, card = None):
+    self.display = display
+    self.slot = slot
+    self.show = show
+    self.hide = hide
+    self.text = text
+    self.start = start
+    self.end = end
+    self.parts = [] if parts is None else parts
+    self.card = card
+
+  def pack(self):
+    """
+      The line as plain tuples, e.g. to store it in a compiled layout.
+    """
+    return (int(self.display), self.slot, self.show, self.hide, self.text, self.start,
+      self.end, tuple((part.text, part.start, part.end) for part in self.parts), self.card)
+
+  @classmethod
+  def unpack(cls, packed):
+    display, slot, show, hide, text, start, end, parts, card = packed
+    return cls(Display(display), slot, show, hide, text, start, end,
+      [Part(*part) for part in parts], card)
+
+class SurfaceCache:
+  """
+    Keeps rendered text surfaces around between frames. The text, color
+    and font size of the lines don't change after the layout step, so
+    there's no need to rasterize the glyphs for every frame again.
+    Surfaces used least recently are evicted once maxsize is exceeded.
+  """
+  def __init__(self, maxsize = 256):
+    self.maxsize = maxsize
+    self.surfaces = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, font, fontSize, text, color):
+    key = (text, color, fontSize)
+    surface = self.surfaces.get(key)
+    if surface is not None:
+      self.hits += 1
+      self.surfaces.move_to_end(key)
+      return surface
+    self.misses += 1
+    surface = font.render(text, True, color)
+    self.surfaces[key] = surface
+    if len(self.surfaces) > self.maxsize:
+      self.surfaces.popitem(last = False)
+    return surface
+
+  def clear(self):
+    self.surfaces.clear()
+
+  def stats(self):
+    total = self.hits + self.misses
+    ratio = self.hits / total if total else 0
+    return "Text cache: %d hits, %d misses (%.1f%% hit rate), %d surfaces" % (
+      self.hits, self.misses, ratio * 100, len(self.surfaces))
+
+class TextMetrics:
+  """
+    Measures text in a font without rendering it. Font.size() places the
+    glyphs exactly like Font.render() does, kerning and subpixel
+    positions included, which adding up the integer glyph advances
+    doesn't. So widths are measured per string and cached instead.
+  """
+  def __init__(self, font, maxsize = 4096):
+    self.font = font
+    self.maxsize = maxsize
+    self.widths = {}
+    # Height of every rendered line, the same for any text.
+    self.height = font.get_height()
+
+  def width(self, text):
+    width = self.widths.get(text)
+    if width is None:
+      if len(self.widths) >= self.maxsize:
+        self.widths.clear()
+      width = self.widths[text] = self.font.size(text)[0]
+    return width
+
+  def offsets(self, parts):
+    """
+      Offsets of the parts of a line in px, measured as the width of the
+      text before them, and the width of the whole line last. So they
+      line up exactly with the line rendered as a whole.
+    """
+    offsets = [0]
+    prefix = ""
+    for part in parts:
+      prefix += part
+      offsets.append(self.width(prefix))
+    return offsets
+
+class FFmpegWriter:
+  """
+    Pipes raw RGB frames straight into an ffmpeg process. write_frame()
+    copies the frame into one of a few preallocated buffers and hands it
+    to a writer thread through a bounded queue, so rendering the next
+    frame overlaps encoding. If the encoder can't keep up, write_frame()
+    blocks until a buffer is free again. The time spent waiting on either
+    side is recorded, see stats().
+  """
+  def __init__(self, filename, size, fps, audiofile = None, codec = "libx264",
+      preset = "medium", crf = None, threads = None, queuesize = 8, ffmpeg_params = None,
+      audiocodec = "libmp3lame", audioargs = None, renditions = None):
+    width, height = size
+    cmd = [ffmpegBinary(), "-y", "-loglevel", "error",
+      "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d" % (width, height),
+      "-r", str(fps), "-i", "-"]
+    if audiofile:
+      cmd += ["-i", audiofile]
+    elif audioargs:
+      # Inputs, filters and mapping of the audio, given by the caller.
+      cmd += audioargs
+
+    # renditions are (filename, width, height, codec) to encode instead of
+    # filename alone. ffmpeg splits the frames and scales them down to
+    # every size, the codec defaults to codec.
+    outputs = [("0:v", filename, codec)]
+    if renditions:
+      # Converted to yuv420p once, and scaled in that, which is half the
+      # pixels of RGB.
+      graph = "[0:v]format=yuv420p,split=%d" % len(renditions) + "".join("[v%d]" % i for i in range(len(renditions)))
+      outputs = []
+      for i, (output, outwidth, outheight, outcodec) in enumerate(renditions):
+        label = "[v%d]" % i
+        if (outwidth, outheight) != (width, height):
+          graph += ";[v%d]scale=%d:%d:flags=area[s%d]" % (i, outwidth, outheight, i)
+          label = "[s%d]" % i
+        outputs.append((label, output, outcodec or codec))
+      cmd += ["-filter_complex", graph]
+
+    for label, output, outcodec in outputs:
+      if not audioargs:
+        cmd += ["-map", label]
+      if audiofile:
+        cmd += ["-map", "1:a", "-c:a", audiocodec]
+      cmd += ["-c:v", outcodec]
+      if preset and outcodec in ("libx264", "libx265"):
+        cmd += ["-preset", preset]
+      if crf is not None:
+        cmd += ["-crf", str(crf)]
+      if threads:
+        cmd += ["-threads", str(threads)]
+      if ffmpeg_params:
+        cmd += ffmpeg_params
+      cmd += ["-pix_fmt", "yuv420p", output]
+
+    self.filename = filename
+    self.errorlog = tempfile.TemporaryFile()
+    self.proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = subprocess.DEVNULL, stderr = self.errorlog)
+
+    self.free = queue.Queue()
+    for i in range(queuesize + 1):
+      self.free.put(numpy.empty((height, width, 3), dtype = numpy.uint8))
+    self.queue = queue.Queue(maxsize = queuesize)
+    self.error = None
+
+    self.frames = 0
+    self.started = time.time()
+    # Producer blocked because the queue was full (backpressure)
+    self.blocked = 0
+    # Writer thread waiting for frames / writing them to ffmpeg
+    self.idle = 0
+    self.writing = 0
+
+    self.thread = threading.Thread(target = self.writer, daemon = True)
+    self.thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def write_frame(self, frame):
+    waiting = time.time()
+    buf = self.free.get()
+    self.blocked += time.time() - waiting
+    if self.error:
+      raise self.error
+    numpy.copyto(buf, frame)
+    self.queue.put(buf)
+    self.frames += 1
+
+  def writer(self):
+    while True:
+      waiting = time.time()
+      buf = self.queue.get()
+      writing = time.time()
+      self.idle += writing - waiting
+      if buf is None:
+        return
+      if not self.error:
+        try:
+          self.proc.stdin.write(buf.data)
+        except (BrokenPipeError, OSError) as e:
+          self.error = IOError("ffmpeg failed writing " + self.filename + ": " + self.errors())
+      self.writing += time.time() - writing
+      self.free.put(buf)
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    try:
+      self.proc.stdin.close()
+    except (BrokenPipeError, OSError):
+      pass
+    if self.proc.wait() != 0 and not self.error:
+      self.error = IOError("ffmpeg failed writing " + self.filename + ": " + self.errors())
+    self.elapsed = time.time() - self.started
+    if self.error:
+      raise self.error
+
+  def abort(self):
+    """
+      Stop ffmpeg without raising, leaving the movie unfinished, when
+      the frames failed to come. The error which stopped them counts.
+    """
+    self.proc.terminate()
+    self.queue.put(None)
+    self.thread.join()
+    try:
+      self.proc.stdin.close()
+    except (BrokenPipeError, OSError):
+      pass
+    self.proc.wait()
+    self.elapsed = time.time() - self.started
+
+  def errors(self):
+    self.proc.wait()
+    self.errorlog.seek(0)
+    return self.errorlog.read().decode(errors = "replace").strip()
+
+  def stats(self):
+    elapsed = getattr(self, "elapsed", time.time() - self.started)
+    return ("Encoder: %d frames in %.1f s, %.1f frames/s. Producer blocked %.1f s, "
+      "writer idle %.1f s, writing %.1f s") % (self.frames, elapsed,
+      self.frames / max(elapsed, 1e-9), self.blocked, self.idle, self.writing)
+
+class FrameSink:
+  """
+    Where the frames of live playback go. "window" shows them in the
+    pygame window, which render() already draws to, "null" drops them.
+    "pipe" and "socket" write them as raw rgb24, for a streaming process
+    to consume, e.g. ffmpeg -f rawvideo. The pipe is stdout or the file
+    (FIFO) given as target, the socket connects to a local HOST:PORT,
+    PORT or the path of a Unix socket.
+  """
+  def __init__(self, kind, target = None):
+    self.kind = kind
+    self.out = None
+    self.sock = None
+    # A raw stream has no timestamps, its consumer relies on getting
+    # every single frame.
+    self.constant = kind in ("pipe", "socket")
+    if kind == "pipe":
+      self.out = sys.__stdout__.buffer if target in (None, "-") else open(target, "wb")
+    elif kind == "socket":
+      if not target:
+        raise IOError("The socket sink needs an address to connect to.")
+      host, sep, port = target.rpartition(":")
+      if port.isdigit():
+        self.sock = socket.create_connection((host or "127.0.0.1", int(port)))
+      else:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(target)
+
+  def write_frame(self, frame):
+    if self.out:
+      self.out.write(numpy.ascontiguousarray(frame).data)
+    elif self.sock:
+      self.sock.sendall(numpy.ascontiguousarray(frame).data)
+    elif self.kind == "window":
+      for event in pygame.event.get():
+        if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+          raise KeyboardInterrupt
+
+  def close(self):
+    if self.out:
+      self.out.flush()
+      if self.out is not sys.__stdout__.buffer:
+        self.out.close()
+    if self.sock:
+      self.sock.close()
+
+class Profiler:
+  """
+    Collects what --profile reports: wall time per stage of the run, the
+    time every frame took to render and the time spent waiting for the
+    encoder. Optionally runs cProfile on the render loop. Nothing of this
+    is set up unless profiling.
+  """
+  def __init__(self, dumpfile = None):
+    self.stages = OrderedDict()
+    self.frametimes = []
+    self.encoderwait = 0
+    self.writer = {"frames": 0, "blocked": 0, "idle": 0, "writing": 0}
+    self.dumpfile = dumpfile
+    self.cprofile = None
+
+  @contextlib.contextmanager
+  def stage(self, name, profiled = False):
+    if profiled and self.dumpfile:
+      import cProfile
+      self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - started
+      if profiled and self.cprofile:
+        self.cprofile.disable()
+        self.cprofile.dump_stats(self.dumpfile)
+
+  def timeRender(self, render):
+    """
+      Wrap render(), recording the time every frame takes.
+    """
+    frametimes = self.frametimes
+    def timed(t):
+      started = time.perf_counter()
+      frame = render(t)
+      frametimes.append(time.perf_counter() - started)
+      return frame
+    return timed
+
+  def encode(self, writer, render, times):
+    """
+      Render and write the frames at times, recording how long writing
+      them blocks.
+    """
+    for t in times:
+      frame = render(t)
+      started = time.perf_counter()
+      writer.write_frame(frame)
+      self.encoderwait += time.perf_counter() - started
+
+  def writerStats(self, writer):
+    self.writer["frames"] += writer.frames
+    self.writer["blocked"] += writer.blocked
+    self.writer["idle"] += writer.idle
+    self.writer["writing"] += writer.writing
+
+  def report(self, app):
+    frametimes = numpy.array(self.frametimes) * 1000
+    drawn = len(frametimes)
+    # Counts per frame time, the upper limit of the bucket in ms
+    buckets = [1, 2, 5, 10, 20, 50, 100]
+    counts = numpy.histogram(frametimes, [0] + buckets + [numpy.inf])[0]
+    histogram = OrderedDict(("< %d ms" % limit, int(count)) for limit, count in zip(buckets, counts))
+    histogram[">= %d ms" % buckets[-1]] = int(counts[-1])
+    frames = len(app.timeline["times"]) if hasattr(app, "timeline") else 0
+    encoderwait = self.encoderwait
+    if not self.writer["frames"] and "movie" in self.stages:
+      # moviepy pulls the frames, everything but rendering them is encoding.
+      encoderwait = self.stages["movie"] - frametimes.sum() / 1000
+
+    return OrderedDict([
+      ("file", app.filename),
+      ("size", [app.width, app.height]),
+      ("fps", app.fps),
+      ("frames", frames),
+      ("stages", OrderedDict((name, round(seconds, 6)) for name, seconds in self.stages.items())),
+      ("render", OrderedDict([
+        ("frames", drawn),
+        ("reused", app.reusedframes if frames else 0),
+        ("total", round(float(frametimes.sum()) / 1000, 6)),
+        ("p50_ms", float(numpy.percentile(frametimes, 50)) if drawn else None),
+        ("p95_ms", float(numpy.percentile(frametimes, 95)) if drawn else None),
+        ("max_ms", float(frametimes.max()) if drawn else None),
+        ("histogram", histogram)
+      ])),
+      ("counters", OrderedDict([
+        ("font_render_calls", app.textcache.misses),
+        ("text_cache_hits", app.textcache.hits),
+        ("bytes_copied", app.copiedbytes if frames else 0),
+        ("frames_copied", app.copiedframes if frames else 0),
+        ("bytes_copied_per_frame", app.copiedbytes / app.copiedframes if frames and app.copiedframes else 0)
+      ])),
+      ("encoder", OrderedDict([
+        ("wait", round(float(encoderwait), 6)),
+        ("writer", self.writer)
+      ]))
+    ])
+
 class KaraOkay:
-  def __init__(self, filename, outfile, audiofile, fontfile, force, debug, suppress_plug):
+  # Fonts loaded in this process along with their measured text, keyed
+  # by font file and size. Shared between instances, so batch workers
+  # load each font only once.
+  fonts = {}
+  maxfonts = 32
+  # Bump whenever the layout or what saveLayout() stores changes, so
+  # compiled layouts of older versions aren't used anymore.
+  layoutVersion = 4
+
+  def __init__(self, filename, outfile, audiofile, fontfile, force, debug, suppress_plug, vfr = False, headless = False, jobs = 1, cachedir = None, size = None, fps = None, preview = False, encoder = None, assfile = None, subtitles = None, layoutfile = None, compositor = "pygame", profile = None, profiledump = None, audioduration = None, live = None, livetarget = None, renditions = None, cachemax = None):
     self.filename = filename
     self.outfile = outfile
     self.audiofile = audiofile
@@ -33,17 +539,69 @@ class KaraOkay:
     self.force_arg = force
     self.debug = debug
     self.suppress_plug = suppress_plug
+    self.vfr = vfr
+    self.headless = headless
+    self.jobs = jobs
+    # Absolute, as ffmpeg's concat demuxer resolves the segments against
+    # the directory of the list.
+    self.cachedir = abspath(cachedir) if cachedir else None
+    # Size in MB the cache directory is kept below, see pruneCache().
+    self.cachemax = cachemax
+    self.preview = preview
+    # Write the layout as ASS subtitles to assfile. With subtitles set to
+    # "burn" or "soft", ffmpeg renders the movie from them.
+    self.assfile = assfile
+    self.subtitles = subtitles
+    # Compiled layout to load instead of parsing and laying out the file.
+    # Defaults to one in the cache directory.
+    self.layoutfile = layoutfile
+    # Draw the frames with pygame, or compose them from pre-blended line
+    # bitmaps with numpy ("numpy"). The pixels are the same.
+    self.compositor = compositor
+    # Write a JSON report of where the time went to profile, and the
+    # cProfile stats of the render loop to profiledump.
+    self.profile = profile
+    self.profiler = Profiler(profiledump) if profile else None
+    # The audio as probed by probeAudio(). Its duration is used for files
+    # without a duration line.
+    self.audio = None
+    self.audioduration = audioduration
+    # Play the song in real time to the given sink instead of writing a
+    # movie, see FrameSink.
+    self.live = live
+    self.livetarget = livetarget
+    # moviepy's progress bar, turned off in batch mode.
+    self.logger = "bar"
+
+    # Encode the movie in several sizes and codecs at once, given as
+    # (width, height, codec) tuples. It is rendered at the largest size,
+    # ffmpeg scales it down for the others.
+    self.renditions = renditions
+    if renditions:
+      size = max(((width, height) for width, height, codec in renditions),
+        key = lambda size: size[0] * size[1])
 
-    self.width, self.height = 1280, 720
+    # The preview is a small, low frame rate proxy encoded as fast as
+    # possible, e.g. to check the timing.
+    self.width, self.height = size or ((640, 360) if preview else (1280, 720))
     self.bgcolor = 0, 0, 50
     self.fontcolor = 240, 240, 240
     self.peekcolor = 150, 150, 150
     self.hicolor = 90, 255, 90
-    self.fps = 30
-    
-    # Seconds: 1, 10, 1.1, 10.99, Minutes: 1:00, 1:01.0
-    self.tsRegex = '(?:(\d+):)?(\d?\d(?:\.\d\d?)?)'
-    self.secondsRegex = '(\d?\d(?:\.\d\d?)?)'
+    self.fps = fps or (10 if preview else 30)
+
+    # Output backend ("moviepy" or "ffmpeg") and encoder settings.
+    self.encoder = {
+      "backend": "moviepy",
+      "codec": "libx264",
+      "preset": "ultrafast" if preview else "medium",
+      "crf": None,
+      "threads": None,
+      "queuesize": 8
+    }
+    for key, value in (encoder or {}).items():
+      if value is not None:
+        self.encoder[key] = value
     
     # Pre start gap. If possible, show the card this many seconds before
     # starting.
@@ -63,28 +621,39 @@ class KaraOkay:
     # (should be identical to self.show_before)
     self.pause_gap = self.show_before
 
+    # Warn if the duration given in the file and the one of the audio
+    # differ by more than this many seconds.
+    self.duration_tolerance = 1
+
     self.slotpositions = []
   
-    self.data = {
-      "timestamps": [],
-      "cards": [],
-      "pre_gaps": [],
-      "post_gaps": [],
-      "duration": 0,
-      "lines": []
-    }
+    # The song: its duration, the cards as parsed and the lines to show
+    # as computed by the layout step.
+    self.duration = 0
+    self.cards = []
+    self.lines = []
 
     self.maxLineLength = self.width * .8
 
     self.referenceFontSize = self.fontSize = 100
 
+    # Rendered text surfaces, shared by render(), show_plug() and the
+    # debug overlay.
+    self.textcache = SurfaceCache()
+    # Text blended onto the background as arrays, for the numpy
+    # compositor.
+    self.bitmaps = OrderedDict()
+    self.solids = {}
+    # The frame handed to the encoders, see copyFrame().
+    self.framebuffer = None
+    self.copiedbytes = 0
+    self.copiedframes = 0
+
     if self.fontfile and isfile(abspath(realpath(self.fontfile))):
       self.fontfile = abspath(realpath(self.fontfile))
     else:
-      self.fontfile = "./fonts/SourceSansPro-Semibold.ttf"
+      self.fontfile = os.path.join(os.path.dirname(abspath(__file__)), "fonts", "SourceSansPro-Semibold.ttf")
 
-    self.updateFont()
-    
   def run(self):
     """
       Parse the file, layout and render the movie.
@@ -92,174 +661,1135 @@ class KaraOkay:
     filename = abspath(realpath(self.filename))
     if not isfile(filename):
       sys.exit(self.filename + ": No such file or directory.")
+    if self.live == "pipe" and self.livetarget in (None, "-"):
+      # The frames go to stdout, so the messages go to stderr.
+      sys.stdout = sys.stderr
+    audiofile = self.openAudio()
+
     try:
-      self.parse(self.filename)
+      self.compile()
     except ParserError as e:
       sys.exit("Parser error. Not a valid kok file. Error occurred in line: " + str(e))
+    if self.durationWarning():
+      print(self.durationWarning())
 
-    outfile = filename + ".mp4"
-    outfile = outfile.replace(".kok", "")
-    if not self.outfile == None:
-      outfile = self.outfile
-    if isfile(outfile) and not self.force_arg:
-      sys.exit("File" + outfile + " already exists. Please remove, use --force or specify a different file using -o.")
+    if self.live:
+      with self.stage("setup"):
+        self.setupScreen()
+      if self.profiler:
+        self.render = self.profiler.timeRender(self.render)
+      with self.stage("live", True):
+        self.playLive(audiofile)
+      self.writeProfile()
+      return
 
-    audioclip = None
-    if self.audiofile:
-      audiofile = abspath(realpath(self.audiofile))
-      if not isfile(audiofile):
-        sys.exit(self.audiofile + ": No such file or directory.")
-      audioclip = AudioFileClip(audiofile)
+    if self.assfile and not self.subtitles:
+      if isfile(self.assfile) and not self.force_arg:
+        sys.exit("File " + self.assfile + " already exists. Please remove or use --force.")
+      with self.stage("ass"):
+        self.writeAss(self.assfile)
+      self.writeProfile()
+      return
 
-    pygame.init()
-    self.screen = pygame.display.set_mode((self.width, self.height))
+    outfile = self.movieFile()
+    outfiles = [outfile]
+    if self.renditions:
+      outfiles = [rendition[0] for rendition in self.renditionFiles(outfile)]
+    for name in outfiles:
+      if isfile(name) and not self.force_arg:
+        sys.exit("File" + name + " already exists. Please remove, use --force or specify a different file using -o.")
 
-    self.layout()
     if self.debug:
       self.debug_output()
 
-    clip = VideoClip(self.render, duration = self.data["duration"])
-    if audioclip:
-      clip = clip.set_audio(audioclip)
-    clip.write_videofile(outfile, fps=self.fps)
+    if self.subtitles:
+      with self.stage("subtitles"):
+        self.renderSubtitles(outfile, audiofile)
+      self.writeProfile()
+      return
+
+    with self.stage("setup"):
+      self.setupScreen()
+    if self.profiler:
+      self.render = self.profiler.timeRender(self.render)
+    if self.renditions:
+      # Rendered once and encoded to all of them by a single ffmpeg. The
+      # time spent rendering is what separate movies would spend again
+      # for every rendition.
+      rendering = 0
+      render = self.render
+      def timed(t):
+        nonlocal rendering
+        started = time.perf_counter()
+        frame = render(t)
+        rendering += time.perf_counter() - started
+        return frame
+      self.render = timed
+      started = time.time()
+      try:
+        with self.stage("movie", True):
+          self.writeFrames(outfile, 0, len(self.timeline["times"]), audiofile)
+      except IOError as e:
+        sys.exit(str(e))
+      self.render = render
+      print("Encoded %d renditions in %.1f s: %s" % (len(outfiles), time.time() - started,
+        ", ".join(outfiles)))
+      print("Rendering took %.1f s of it, done once instead of %d times for separate movies." % (
+        rendering, len(outfiles)))
+    elif self.jobs > 1 or self.cachedir or self.encoder["backend"] == "ffmpeg":
+      try:
+        if self.jobs > 1 or self.cachedir:
+          self.renderSegments(outfile, audiofile)
+        else:
+          with self.stage("movie", True):
+            self.writeFrames(outfile, 0, len(self.timeline["times"]), audiofile)
+      except IOError as e:
+        sys.exit(str(e))
+    else:
+      # Not moviepy.editor, which initializes pygame's display on import.
+      from moviepy.video.VideoClip import VideoClip
+      from moviepy.audio.io.AudioFileClip import AudioFileClip
+      clip = VideoClip(self.render, duration = self.duration)
+      # moviepy copies the audio stream of a file passed as audio, the
+      # clip's audio is decoded and encoded again.
+      audio = True
+      ffmpeg_params = self.encoderParams()
+      if audiofile and self.audioCodec(outfile) == "copy":
+        audio = audiofile
+      elif audiofile:
+        clip = clip.set_audio(AudioFileClip(audiofile))
+      if audiofile:
+        ffmpeg_params += self.durationParams()
+      if self.vfr:
+        ffmpeg_params += self.vfrParams(outfile + ".vfr")
+      with self.stage("movie", True):
+        clip.write_videofile(outfile, fps=self.fps, codec=self.encoder["codec"],
+          preset=self.encoder["preset"], threads=self.encoder["threads"],
+          ffmpeg_params=ffmpeg_params, audio=audio, logger=self.logger)
+      if self.vfr:
+        os.remove(outfile + ".vfr")
+
+    if self.debug:
+      print(self.textcache.stats())
+      frames = len(self.timeline["times"])
+      print("Static frames: %d of %d reused" % (self.reusedframes, frames))
+      print("Frame copies: %.2f MB in total, %.2f MB per frame" % (
+        self.copiedbytes / 1e6, self.copiedbytes / 1e6 / max(self.copiedframes, 1)))
+    if self.cachedir and self.cachemax is not None:
+      self.pruneCache()
+    self.writeProfile()
+
+  def pruneCache(self):
+    """
+      Remove the least recently used segments and layouts from the cache
+      directory until it holds no more than self.cachemax MB. Files may
+      be removed by other processes sharing it meanwhile.
+    """
+    files = []
+    for entry in os.scandir(self.cachedir):
+      if entry.name.endswith((".mp4", ".layout")) and entry.is_file():
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for mtime, size, path in files)
+    removed = 0
+    for mtime, size, path in sorted(files):
+      if total <= self.cachemax * 1e6:
+        break
+      try:
+        os.remove(path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+      total -= size
+    if removed:
+      print("Removed %d files from the cache, %.1f MB left." % (removed, total / 1e6))
+
+  def playLive(self, audiofile = None):
+    """
+      Render the frames on the wall clock, each one due at its time in
+      the song. If rendering or the sink falls behind by more than a
+      frame, the frames in between are dropped to catch up instead of
+      drifting. Sinks relying on every frame get the last one again
+      instead. The audio is played along in the window. Prints how late
+      the frames were and how many were dropped.
+    """
+    try:
+      sink = FrameSink(self.live, self.livetarget)
+    except OSError as e:
+      sys.exit("Failed to open the live output: " + str(e))
+    times = self.timeline["times"]
+    period = 1 / self.fps
+    lateness = []
+    dropped = repeated = 0
+    frame = None
+
+    if audiofile and self.live == "window":
+      try:
+        pygame.mixer.init()
+        pygame.mixer.music.load(audiofile)
+        pygame.mixer.music.play()
+      except pygame.error as e:
+        print("Warning: Can't play " + self.audiofile + ": " + str(e))
+    started = time.perf_counter()
+    idx = 0
+    try:
+      while idx < len(times):
+        due = started + idx * period
+        now = time.perf_counter()
+        if now < due:
+          time.sleep(due - now)
+        elif now - due > period:
+          # Late: catch up with the clock.
+          current = min(int((now - started) / period), len(times) - 1)
+          if sink.constant and frame is not None:
+            for i in range(idx, current):
+              sink.write_frame(frame)
+            repeated += current - idx
+          else:
+            dropped += current - idx
+          idx = current
+          due = started + idx * period
+        frame = self.render(times[idx])
+        sink.write_frame(frame)
+        lateness.append(time.perf_counter() - due)
+        idx += 1
+    except KeyboardInterrupt:
+      pass
+    except OSError as e:
+      print("Live output closed: " + str(e))
+    finally:
+      sink.close()
+      if audiofile and self.live == "window" and pygame.mixer.get_init():
+        pygame.mixer.music.stop()
+
+    lateness = numpy.array(lateness) * 1000
+    if len(lateness):
+      print("Live: %d frames shown, %d dropped, %d repeated. Latency p50 %.1f ms, p95 %.1f ms, max %.1f ms." % (
+        len(lateness), dropped, repeated, numpy.percentile(lateness, 50),
+        numpy.percentile(lateness, 95), lateness.max()))
+
+  def validate(self, format = "text"):
+    """
+      Check the file and print the timings of its lines like --debug
+      does, or as JSON. Only the timing part of the layout is done, so
+      neither fonts nor video are set up, and pygame, numpy and moviepy
+      are never imported.
+    """
+    filename = abspath(realpath(self.filename))
+    if not isfile(filename):
+      sys.exit(self.filename + ": No such file or directory.")
+    self.openAudio()
+
+    try:
+      self.parse(filename)
+      self.layoutTiming()
+    except ParserError as e:
+      sys.exit("Parser error. Not a valid kok file. Error occurred in line: " + str(e))
+
+    if format == "json":
+      print(json.dumps(self.inspect(), indent = 2))
+      return
+    if self.durationWarning():
+      print(self.durationWarning())
+    self.debug_output()
+
+  def inspect(self):
+    """
+      The cards and lines with their timings as plain dict.
+    """
+    warning = self.durationWarning()
+    return OrderedDict([
+      ("file", self.filename),
+      ("duration", self.duration),
+      ("warnings", [warning] if warning else []),
+      ("cards", [OrderedDict([
+        ("start", card.start), ("end", card.end), ("show", card.show), ("hide", card.hide),
+        ("display", card.display.name.lower()), ("peek", card.peek)
+      ]) for card in self.cards]),
+      ("lines", [OrderedDict([
+        ("display", line.display.name.lower()), ("slot", line.slot), ("card", line.card),
+        ("show", line.show), ("hide", line.hide), ("text", line.text),
+        ("start", line.start), ("end", line.end),
+        ("parts", [OrderedDict([("text", part.text), ("start", part.start), ("end", part.end)])
+          for part in line.parts])
+      ]) for line in self.lines])
+    ])
+
+  def openAudio(self):
+    """
+      Check and probe the audio file, if any. Returns its absolute path.
+    """
+    if not self.audiofile:
+      return None
+    audiofile = abspath(realpath(self.audiofile))
+    if not isfile(audiofile):
+      sys.exit(self.audiofile + ": No such file or directory.")
+    self.audio = probeAudio(audiofile)
+    if not self.audio["codecs"]:
+      sys.exit(self.audiofile + ": No audio stream found.")
+    self.audioduration = self.audio["duration"]
+    return audiofile
+
+  def durationWarning(self):
+    """
+      A warning if the duration given in the file and the one of the
+      audio don't match, None otherwise.
+    """
+    if self.audioduration and abs(self.duration - self.audioduration) > self.duration_tolerance:
+      return "Warning: The duration of %s (%.2f s) differs from the one of the audio (%.2f s)." % (
+        self.filename, self.duration, self.audioduration)
+    return None
+
+  def stage(self, name, profiled = False):
+    """
+      Context timing a stage of the run when profiling, running cProfile
+      on it if profiled. Does nothing otherwise.
+    """
+    if self.profiler:
+      return self.profiler.stage(name, profiled)
+    return contextlib.nullcontext()
+
+  def writeProfile(self):
+    """
+      Write the --profile report. With more than one job, the segments
+      rendered by the workers are not included.
+    """
+    if not self.profiler:
+      return
+    with open(self.profile, "w") as f:
+      json.dump(self.profiler.report(self), f, indent = 2)
+    print("Profile written to " + self.profile)
   
+  def prepare(self):
+    """
+      Parse and layout the movie and set up the surface to draw on,
+      without any of the checks of run(). Used by the worker processes.
+    """
+    self.compile()
+    self.setupScreen()
+
+  def compile(self):
+    """
+      Parse and layout the movie, unless there's a compiled layout of the
+      same file, font and settings to load. Compiled layouts are kept in
+      self.layoutfile or the cache directory.
+    """
+    layoutfile = self.layoutPath()
+    if layoutfile:
+      with self.stage("load layout"):
+        if self.loadLayout(layoutfile):
+          if not self.layoutfile:
+            # Touch it, so the least recently used can be cleaned up.
+            os.utime(layoutfile)
+          return
+    with self.stage("parse"):
+      self.parse(self.filename)
+    with self.stage("layout"):
+      self.layout()
+    if layoutfile:
+      self.saveLayout(layoutfile)
+
+  def layoutPath(self):
+    """
+      Where the compiled layout is kept, None if nowhere.
+    """
+    if self.layoutfile:
+      return self.layoutfile
+    if self.cachedir:
+      return os.path.join(self.cachedir, self.layoutKey() + ".layout")
+    return None
+
+  def movieFile(self):
+    """
+      Name of the movie: the one given, or guessed from the input file.
+    """
+    if not self.outfile == None:
+      return self.outfile
+    outfile = abspath(realpath(self.filename)) + (".preview.mp4" if self.preview else ".mp4")
+    return outfile.replace(".kok", "")
+
+  def renderKey(self):
+    """
+      Hash of the settings a movie depends on, apart from the song: the
+      font, size, frame rate, timing thresholds and encoder settings.
+    """
+    key = hashlib.sha256()
+    key.update(repr((
+      "layout-%d" % KaraOkay.layoutVersion, fileHash(self.fontfile),
+      self.width, self.height, self.fps, self.maxLineLength, self.referenceFontSize,
+      self.show_before, self.cue_length, self.peek_threshold,
+      self.pause_threshold, self.pause_gap, self.debug, self.suppress_plug, self.vfr,
+      self.encoder["codec"], self.encoder["preset"], self.encoder["crf"]
+    )).encode())
+    return key.hexdigest()
+
+  def layoutKey(self):
+    """
+      Hash of everything the layout depends on: the kok file, the font,
+      the size of the movie, the timing thresholds and the duration of
+      the audio, for files not giving one.
+    """
+    key = hashlib.sha256()
+    key.update(repr((
+      "layout-%d" % KaraOkay.layoutVersion,
+      fileHash(abspath(realpath(self.filename))), fileHash(self.fontfile),
+      self.width, self.height, self.maxLineLength, self.referenceFontSize,
+      self.show_before, self.cue_length, self.peek_threshold,
+      self.pause_threshold, self.pause_gap, self.audioduration
+    )).encode())
+    return key.hexdigest()
+
+  def saveLayout(self, filename):
+    """
+      Write the compiled layout: the parsed cards, the resolved lines and
+      their parts, the slot positions, font size and line height.
+    """
+    os.makedirs(os.path.dirname(abspath(filename)), exist_ok = True)
+    layout = {
+      "version": KaraOkay.layoutVersion,
+      "key": self.layoutKey(),
+      "duration": self.duration,
+      # The lyrics of the cards are only needed to layout the lines.
+      "cards": [(card.start, card.end) for card in self.cards],
+      "lines": [line.pack() for line in self.lines],
+      "slotpositions": self.slotpositions,
+      "fontSize": self.fontSize,
+      "lineheight": self.lineheight
+    }
+    # Write it under a different name first, other processes may be
+    # reading the file.
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpfile, "wb") as f:
+      pickle.dump(layout, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfile, filename)
+
+  def loadLayout(self, filename):
+    """
+      Load a compiled layout written by saveLayout() and build the
+      timeline from it. Returns False if there's none, or it doesn't
+      match the file, font and settings. A broken one is reported and
+      ignored, so it's compiled again.
+    """
+    try:
+      with open(filename, "rb") as f:
+        layout = pickle.load(f)
+      if (not isinstance(layout, dict) or layout.get("version") != KaraOkay.layoutVersion
+          or layout.get("key") != self.layoutKey()):
+        return False
+      duration = layout["duration"]
+      cards = [Card(start, end) for start, end in layout["cards"]]
+      lines = [Line.unpack(line) for line in layout["lines"]]
+      slotpositions = layout["slotpositions"]
+      fontSize = layout["fontSize"]
+      lineheight = layout["lineheight"]
+    except FileNotFoundError:
+      return False
+    except Exception as e:
+      print("Ignoring the compiled layout %s: %s: %s" % (filename, type(e).__name__, e))
+      return False
+
+    self.duration = duration
+    self.cards = cards
+    self.lines = lines
+    self.slotpositions = slotpositions
+    self.fontSize = fontSize
+    self.updateFont()
+    self.lineheight = lineheight
+    self.buildTimeline()
+    return True
+
+  def setupScreen(self):
+    if self.headless:
+      # Draw into an offscreen surface, the display is never touched.
+      self.screen = pygame.Surface((self.width, self.height), 0, 32)
+    else:
+      pygame.init()
+      self.screen = pygame.display.set_mode((self.width, self.height))
+
+  def renderSegments(self, outfile, audiofile):
+    """
+      Split the movie into segments, render and encode them and join them
+      without encoding the video again. The audio is muxed in once at the
+      end. With more than one job, the segments are rendered in worker
+      processes. With a cache directory, segments already encoded before
+      are taken from the cache and new ones are added to it.
+    """
+    segments = self.segmentFrames(self.jobs * 2)
+    options = {
+      "layoutfile": self.layoutPath(),
+      "filename": self.filename,
+      "outfile": None,
+      "audiofile": None,
+      "fontfile": self.fontfile,
+      "force": True,
+      "debug": self.debug,
+      "suppress_plug": self.suppress_plug,
+      "vfr": self.vfr,
+      "headless": True,
+      "size": (self.width, self.height),
+      "fps": self.fps,
+      "preview": self.preview,
+      "encoder": self.encoder,
+      "compositor": self.compositor,
+      "audioduration": self.audioduration
+    }
+
+    tmpdir = None
+    if self.cachedir:
+      os.makedirs(self.cachedir, exist_ok = True)
+      tmpdir = self.cachedir
+    with tempfile.TemporaryDirectory(dir = tmpdir) as tmpdir:
+      if not options["layoutfile"]:
+        # Hand the layout to the workers instead of having every one of
+        # them compute it again.
+        options["layoutfile"] = os.path.join(tmpdir, "movie.layout")
+        self.saveLayout(options["layoutfile"])
+      segmentfiles = []
+      jobs = []
+      for idx, (first, last) in enumerate(segments):
+        segmentfile = os.path.join(tmpdir, "segment%04d.mp4" % idx)
+        if self.cachedir:
+          cachefile = os.path.join(self.cachedir, self.segmentKey(first, last) + ".mp4")
+          if isfile(cachefile):
+            # Touch it, so the least recently used can be cleaned up.
+            os.utime(cachefile)
+            segmentfiles.append(cachefile)
+            continue
+          segmentfiles.append(cachefile)
+        else:
+          segmentfiles.append(segmentfile)
+        jobs.append((options, first, last, segmentfile, segmentfiles[-1]))
+
+      if self.cachedir:
+        print("Reusing %d of %d segments from the cache." % (len(segments) - len(jobs), len(segments)))
+
+      with self.stage("segments", True):
+        self.renderJobs(jobs)
+
+      for options, first, last, segmentfile, target in jobs:
+        if segmentfile != target:
+          os.replace(segmentfile, target)
+
+      with self.stage("concat"):
+        self.concatSegments(segmentfiles, outfile, audiofile, tmpdir)
+
+  def renderJobs(self, jobs):
+    """
+      Render the segments of jobs, in a pool of workers with more than
+      one job.
+    """
+    done = 0
+    if self.jobs > 1 and len(jobs) > 1:
+      # Spawn fresh interpreters, every worker has its own pygame state.
+      context = multiprocessing.get_context("spawn")
+      with context.Pool(self.jobs) as pool:
+        for first, last in pool.imap_unordered(renderSegment, [job[:4] for job in jobs]):
+          done += 1
+          print("Segment %d/%d done (frames %d - %d)" % (done, len(jobs), first, last - 1))
+    else:
+      for options, first, last, segmentfile, target in jobs:
+        self.writeFrames(segmentfile, first, last)
+        done += 1
+        print("Segment %d/%d done (frames %d - %d)" % (done, len(jobs), first, last - 1))
+
+  def segmentFrames(self, count):
+    """
+      Split the frames of the movie into at least count segments, if
+      possible. Cuts are placed where lines are shown or hidden, which
+      keeps the segments stable when other cards change. Segments shorter
+      than a second are merged into the one before, the longest segments
+      are split until we've got count segments. Returns a list of
+      (first, last) frames, last being exclusive.
+    """
+    frames = len(self.timeline["times"])
+    minimum = self.fps
+
+    cuts = [0]
+    for event in self.timeline["events"]:
+      if event - cuts[-1] >= minimum and frames - event >= minimum:
+        cuts.append(int(event))
+    cuts.append(frames)
+    segments = list(zip(cuts[:-1], cuts[1:]))
+
+    while len(segments) < count:
+      first, last = max(segments, key = lambda segment: segment[1] - segment[0])
+      if last - first < 2 * minimum:
+        break
+      segments.remove((first, last))
+      middle = (first + last) // 2
+      segments += [(first, middle), (middle, last)]
+    return sorted(segments)
+
+  def segmentKey(self, first, last):
+    """
+      Content address of the encoded segment of the frames first to
+      last - 1. It covers everything the pixels depend on: the timeline
+      rows, text, type and position of the lines shown, the font, the
+      resolved layout and the encoder settings which change the encoded
+      video, unlike the backend, threads or queue size. Line ids are
+      replaced by the order they appear in, so the key doesn't change if
+      lines are added or removed elsewhere.
+    """
+    timeline = self.timeline
+    rows = timeline["lines"][first:last]
+    ids, seen, inverse = numpy.unique(rows, return_index = True, return_inverse = True)
+    rank = numpy.argsort(numpy.argsort(seen))
+    canonical = numpy.where(rows < 0, -1, rank[inverse.reshape(rows.shape)])
+    appearance = ids[numpy.argsort(seen)]
+
+    key = hashlib.sha256()
+    key.update(repr((
+      "segment-1", last - first, self.width, self.height, self.fps,
+      self.encoder["codec"], self.encoder["preset"], self.encoder["crf"],
+      self.vfr, self.debug,
+      fileHash(self.fontfile), self.fontSize, self.lineheight,
+      self.maxLineLength, self.bgcolor, self.fontcolor, self.peekcolor,
+      self.hicolor, ffmpegBinary()
+    )).encode())
+    for line_id in appearance:
+      if line_id < 0:
+        continue
+      line = self.lines[line_id]
+      key.update(repr((int(line.display), line.text,
+        self.slotpositions[line.slot])).encode())
+    for table in (canonical, timeline["wipes"][first:last], timeline["cues"][first:last], timeline["plug"][first:last]):
+      key.update(numpy.ascontiguousarray(table).tobytes())
+    if self.debug:
+      key.update(timeline["times"][first:last].tobytes())
+    return key.hexdigest()
+
+  def writeFrames(self, filename, first, last, audiofile = None):
+    """
+      Render the frames first to last - 1 and encode them to filename,
+      using the configured backend.
+    """
+    ffmpeg_params = self.encoderParams()
+    if audiofile:
+      ffmpeg_params += self.durationParams()
+    if self.vfr:
+      ffmpeg_params += self.vfrParams(filename + ".vfr", first, last)
+    if self.encoder["backend"] == "ffmpeg" or self.renditions:
+      writer = FFmpegWriter(filename, (self.width, self.height), self.fps,
+        audiofile = audiofile, codec = self.encoder["codec"],
+        preset = self.encoder["preset"], threads = self.encoder["threads"],
+        queuesize = self.encoder["queuesize"], ffmpeg_params = ffmpeg_params,
+        audiocodec = self.audioCodec(filename),
+        renditions = self.renditionFiles(filename) if self.renditions else None)
+    else:
+      from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+      writer = FFMPEG_VideoWriter(filename, (self.width, self.height), self.fps,
+        codec = self.encoder["codec"], preset = self.encoder["preset"],
+        threads = self.encoder["threads"], audiofile = audiofile,
+        ffmpeg_params = ffmpeg_params)
+    with writer:
+      if self.profiler:
+        self.profiler.encode(writer, self.render, self.timeline["times"][first:last])
+      else:
+        for frame in range(first, last):
+          writer.write_frame(self.render(self.timeline["times"][frame]))
+    if self.profiler and isinstance(writer, FFmpegWriter):
+      self.profiler.writerStats(writer)
+    if self.vfr:
+      os.remove(filename + ".vfr")
+    if self.debug and isinstance(writer, FFmpegWriter):
+      print(writer.stats())
+
+  def renditionFiles(self, outfile):
+    """
+      The renditions as (filename, width, height, codec), the file named
+      after outfile and the height, plus the codec if one was given, e.g.
+      happy.720p.mp4 or happy.1080p.libx265.mp4.
+    """
+    stem, ext = os.path.splitext(outfile)
+    return [("%s.%dp%s%s" % (stem, height, "." + codec if codec else "", ext), width, height, codec)
+      for width, height, codec in self.renditions]
+
+  def audioCodec(self, outfile):
+    """
+      Codec to encode the audio of outfile with, "copy" if the streams
+      of the audio file may be muxed into the movie as they are.
+    """
+    ext = os.path.splitext(outfile)[1].lower()
+    if self.audio and set(self.audio["codecs"]) <= copyableAudio.get(ext, set()):
+      return "copy"
+    return "libmp3lame"
+
+  def encoderParams(self):
+    """
+      ffmpeg output parameters not covered by the writers' arguments.
+    """
+    if self.encoder["crf"] is None:
+      return []
+    return ["-crf", str(self.encoder["crf"])]
+
+  def durationParams(self):
+    """
+      ffmpeg output parameters ending the movie with the song, cutting
+      off the rest of a longer audio file, whichever way it is written.
+    """
+    return ["-t", "%.3f" % self.duration]
+
+  def concatSegments(self, segmentfiles, outfile, audiofile, tmpdir):
+    """
+      Join the encoded segments using ffmpeg's concat demuxer, copying
+      the video stream and adding the audio, if any.
+    """
+    listfile = os.path.join(tmpdir, "segments.txt")
+    with open(listfile, "w") as f:
+      for segmentfile in segmentfiles:
+        f.write("file '" + segmentfile.replace("'", "'\\''") + "'\n")
+
+    cmd = [ffmpegBinary(), "-y", "-loglevel", "error",
+      "-f", "concat", "-safe", "0", "-i", listfile]
+    if audiofile:
+      cmd += ["-i", audiofile, "-map", "0:v", "-map", "1:a", "-c:a", self.audioCodec(outfile)]
+      cmd += self.durationParams()
+    cmd += ["-c:v", "copy", outfile]
+    proc = subprocess.run(cmd, stderr = subprocess.PIPE)
+    if proc.returncode != 0:
+      sys.exit("Failed to join the segments: " + proc.stderr.decode(errors = "replace"))
+
   def render(self, t):
     """
-      Producer for moviepy.editor.Videoclip. t is time in seconds
+      Producer of the frames for all output backends, returning the
+      frame at time t in seconds as HxWx3 array.
     """
+    frame = self.frameIndex(t)
+    timeline = self.timeline
+
+    # Nothing changed since the last frame we've drawn, reuse it.
+    if self.lastframe is not None and timeline["spans"][frame] == self.lastspan:
+      self.reusedframes += 1
+      return self.lastframe
+    self.lastspan = timeline["spans"][frame]
+
+    # The debug time may overlap the lines, which only pygame blends.
+    if self.compositor == "numpy" and not self.debug:
+      self.lastframe = self.composite(frame)
+      if not self.headless:
+        pygame.surfarray.blit_array(self.screen, self.lastframe.transpose(1, 0, 2))
+        pygame.display.flip()
+      return self.lastframe
+
     self.drawBackground()
     if self.debug:
-      text = self.font.render(str(int(t*100)/100), True, self.fontcolor)
+      text = self.renderText(str(int(t*100)/100), self.fontcolor)
       self.screen.blit(text, text.get_rect())
-    
-    displaylines = []
-    last_hide = 0
-    for line in self.data["lines"]:
-      if line["hide"] > last_hide:
-        last_hide = line["hide"]
-      if line["show"] > t or line["hide"] <= t:
-        continue
-      displaylines.append(line)
 
-    if not self.suppress_plug and t > last_hide:
+    if timeline["plug"][frame]:
       self.show_plug()
 
-    if len(displaylines) == 0: 
-      pygame.display.flip()
-      return numpy.flip(numpy.rot90(pygame.surfarray.array3d(self.screen)), 0)
+    for col, line_id in enumerate(timeline["lines"][frame]):
+      if line_id < 0:
+        break
+      line = self.lines[line_id]
+      wipe = timeline["wipes"][frame, col]
 
-    for line in displaylines:
-      if line["display"] == "pause":
+      if line.display == Display.PAUSE:
         rect = pygame.Rect(0, 0, self.maxLineLength , self.lineheight)
-        rect.midtop = self.width/2, self.slotpositions[line["slot"]]
+        rect.midtop = self.width/2, self.slotpositions[line.slot]
         pygame.draw.rect(self.screen, self.fontcolor, rect)
-        
-        percentage = (t - line["show"])/(line["hide"] - line["show"])
-        w = self.maxLineLength  * percentage
-        rect2 = pygame.Rect(0, 0, w , self.lineheight)
+        rect2 = pygame.Rect(0, 0, wipe , self.lineheight)
         rect2.topleft = rect.topleft
         pygame.draw.rect(self.screen, self.hicolor, rect2)
         continue
               
       textcolor = self.fontcolor
-      if line["display"] == "peek":
+      if line.display == Display.PEEK:
         textcolor = self.peekcolor
-      text = self.font.render(line["text"], True, textcolor)
+      text = self.renderText(line.text, textcolor)
       textrect = text.get_rect()
       textrect.centerx = self.width/2
-      textrect.top = self.slotpositions[line["slot"]]
+      textrect.top = self.slotpositions[line.slot]
       self.screen.blit(text, textrect)
-      if line["display"] == "peek":
+      if line.display == Display.PEEK:
         # peek lines will never be highlighted
         continue
       
-      # Highlighting
-      if line["parts"] == False:
-        percentage = 0
-        if t > line["start"]:
-          percentage = (t - line["start"])/(line["end"] - line["start"] - 1/self.fps)
-        if percentage > 1:
-          percentage = 1
-        cliptext = self.font.render(line["text"], True, self.hicolor)
-        cliprect =  pygame.Rect(0, 0, textrect.w * percentage, textrect.h)
-        cliptext = cliptext.subsurface(cliprect)
-        self.screen.blit(cliptext, textrect)
-      else:
-        lastoffset = 0
-        for part in line["parts"]:
-          percentage = 0
-          if t > line["start"]:
-            percentage = (t - part["start"])/(part["end"] - part["start"] - 1/self.fps)
-          if percentage <= 0:
-            continue
-          if percentage > 1:
-            percentage = 1
+      # Highlighting. The wipe is a clipped part of the pre-rendered
+      # highlighted line.
+      if wipe > 0:
+        cliptext = self.renderText(line.text, self.hicolor)
+        cliprect = pygame.Rect(0, 0, min(wipe, cliptext.get_width()), textrect.h)
+        self.screen.blit(cliptext.subsurface(cliprect), textrect)
 
-          cliptext = self.font.render(part["text"], True, self.hicolor)
-          cliprect = cliptext.get_rect()
-          cliprect =  pygame.Rect(0, 0, cliprect.w * percentage, cliprect.h)
-          cliptext = cliptext.subsurface(cliprect)
+      cue = timeline["cues"][frame, col]
+      if cue >= 0:
+        rect = pygame.Rect(0, 0, cue, self.lineheight)
+        rect.topright = textrect.topleft
+        pygame.draw.rect(self.screen, self.fontcolor, rect)
 
-          cliprect.left = textrect.left + lastoffset
-          cliprect.top = textrect.top
-          lastoffset += cliprect.w
+    if not self.headless:
+      pygame.display.flip()
+    
+    self.lastframe = self.copyFrame()
+    return self.lastframe
 
-          self.screen.blit(cliptext, cliprect)
+  def composite(self, frame):
+    """
+      The numpy compositor. Builds the frame in the frame buffer by
+      slice assignment: the background, the lines rasterized once by
+      rasterize(), the highlight as range of columns taken from the
+      highlighted version and the bars as filled slices. Geometry is
+      computed with pygame.Rect, exactly like render() draws it.
+    """
+    if self.framebuffer is None:
+      self.framebuffer = numpy.empty((self.height, self.width, 3), dtype = numpy.uint8)
+    self.framebuffer[:] = self.solid(self.bgcolor)
+    timeline = self.timeline
 
-      if line["display"] == "cue":
-        percentage = 1
-        if t > line["start"] - self.cue_length:
-          percentage = (line["start"] - t)/self.cue_length
-        if t > line["start"]:
-          continue
-        rect = pygame.Rect(0, 0, self.lineheight * percentage , self.lineheight)
+    if timeline["plug"][frame]:
+      bitmap = self.rasterize("kara-okay.github.io", self.peekcolor)[0]
+      rect = pygame.Rect(0, 0, bitmap.shape[1], bitmap.shape[0])
+      rect.midbottom = (self.width/2, self.height - self.lineheight * 0.5)
+      self.paste(bitmap, rect)
+
+    for col, line_id in enumerate(timeline["lines"][frame]):
+      if line_id < 0:
+        break
+      line = self.lines[line_id]
+      wipe = timeline["wipes"][frame, col]
+
+      if line.display == Display.PAUSE:
+        rect = pygame.Rect(0, 0, self.maxLineLength , self.lineheight)
+        rect.midtop = self.width/2, self.slotpositions[line.slot]
+        self.fill(rect, self.fontcolor)
+        rect2 = pygame.Rect(0, 0, wipe , self.lineheight)
+        rect2.topleft = rect.topleft
+        self.fill(rect2, self.hicolor)
+        continue
+
+      if line.display == Display.PEEK:
+        bitmap, highlight = self.rasterize(line.text, self.peekcolor)
+      else:
+        bitmap, highlight = self.rasterize(line.text, self.fontcolor, self.hicolor)
+      textrect = pygame.Rect(0, 0, bitmap.shape[1], bitmap.shape[0])
+      textrect.centerx = self.width/2
+      textrect.top = self.slotpositions[line.slot]
+      self.paste(bitmap, textrect)
+      if highlight is None:
+        continue
+
+      if wipe > 0:
+        cliprect = pygame.Rect(textrect.topleft, (min(wipe, textrect.w), textrect.h))
+        self.paste(highlight, cliprect)
+
+      cue = timeline["cues"][frame, col]
+      if cue >= 0:
+        rect = pygame.Rect(0, 0, cue, self.lineheight)
         rect.topright = textrect.topleft
-        pygame.draw.rect(self.screen, self.fontcolor, rect)
+        self.fill(rect, self.fontcolor)
 
-    pygame.display.flip()
-    
-    return numpy.flip(numpy.rot90(pygame.surfarray.array3d(self.screen)), 0)
+    return self.framebuffer
+
+  def rasterize(self, text, color, hicolor = None):
+    """
+      The text blitted onto the background, as HxWx3 array. With
+      hicolor, also the text in hicolor blitted on top of that, the way
+      render() highlights it, else None. Both are blended by pygame into
+      a surface of the screen's format, so they hold the same pixels the
+      pygame compositor produces.
+    """
+    key = (text, color, hicolor, self.fontSize)
+    bitmaps = self.bitmaps.get(key)
+    if bitmaps is not None:
+      self.bitmaps.move_to_end(key)
+      return bitmaps
+
+    surface = self.renderText(text, color)
+    canvas = pygame.Surface(surface.get_size(), 0, self.screen)
+    canvas.fill(self.bgcolor)
+    canvas.blit(surface, (0, 0))
+    bitmap = pygame.surfarray.array3d(canvas).transpose(1, 0, 2).copy()
+    highlight = None
+    if hicolor is not None:
+      canvas.blit(self.renderText(text, hicolor), (0, 0))
+      highlight = pygame.surfarray.array3d(canvas).transpose(1, 0, 2).copy()
+
+    bitmaps = self.bitmaps[key] = (bitmap, highlight)
+    if len(self.bitmaps) > 256:
+      self.bitmaps.popitem(last = False)
+    return bitmaps
+
+  def paste(self, bitmap, rect):
+    """
+      Copy the top left rect.w x rect.h pixels of bitmap to rect in the
+      frame buffer, clipped to the frame.
+    """
+    area = rect.clip(pygame.Rect(0, 0, self.width, self.height))
+    if area.w <= 0 or area.h <= 0:
+      return
+    top, left = area.top - rect.top, area.left - rect.left
+    self.framebuffer[area.top:area.bottom, area.left:area.right] = bitmap[top:top + area.h, left:left + area.w]
+
+  def fill(self, rect, color):
+    """
+      Fill rect in the frame buffer, clipped to the frame.
+    """
+    area = rect.clip(pygame.Rect(0, 0, self.width, self.height))
+    if area.w > 0 and area.h > 0:
+      self.framebuffer[area.top:area.bottom, area.left:area.right] = self.solid(color)[:area.w]
+
+  def solid(self, color):
+    """
+      A row of pixels in color, as wide as the frame. Assigning a tuple
+      to a slice goes through numpy's generic broadcasting, which is
+      way slower than copying rows.
+    """
+    row = self.solids.get(color)
+    if row is None:
+      row = self.solids[color] = numpy.empty((self.width, 3), dtype = numpy.uint8)
+      row[:] = color
+    return row
+
+  def copyFrame(self):
+    """
+      Copy the screen into the preallocated, C-contiguous HxWx3 frame
+      buffer, which is reused for every frame. The pixels are read
+      through a view on the surface's buffer, so this is the only copy
+      made on our side.
+    """
+    if self.framebuffer is None:
+      self.framebuffer = numpy.empty((self.height, self.width, 3), dtype = numpy.uint8)
+
+    if self.screen.get_bytesize() != 4:
+      pixels = pygame.surfarray.pixels3d(self.screen)
+      numpy.copyto(self.framebuffer, pixels.transpose(1, 0, 2))
+      del pixels
+    else:
+      buf = self.screen.get_buffer()
+      pixels = numpy.frombuffer(buf, dtype = numpy.uint8)
+      pixels = pixels.reshape(self.height, self.screen.get_pitch() // 4, 4)
+      for channel, shift in enumerate(self.screen.get_shifts()[:3]):
+        byte = shift // 8 if sys.byteorder == "little" else 3 - shift // 8
+        self.framebuffer[:, :, channel] = pixels[:, :self.width, byte]
+      # Release the view, which keeps the surface locked.
+      del pixels, buf
+
+    self.copiedbytes += self.framebuffer.nbytes
+    self.copiedframes += 1
+    return self.framebuffer
+
+  def frameIndex(self, t):
+    """
+      Return the row of the timeline for the time t in seconds.
+    """
+    frame = int(round(t * self.fps))
+    return min(max(frame, 0), len(self.timeline["times"]) - 1)
+
+  def buildTimeline(self):
+    """
+      Precompute what is shown on every frame of the movie, so render()
+      only needs to look up a row instead of scanning all the lines.
+
+      "lines" holds the indices into self.lines visible on each
+      frame in drawing order, padded with -1. "wipes" holds the width
+      of the highlight (or of the pause bar) in px and "cues" the width
+      of the cue marker in px, -1 if none is shown. "events" are the
+      sorted frames at which lines are shown or hidden.
+
+      Frames which look exactly like the frame before are marked in
+      "static". "spans" holds the first frame of the static span every
+      frame belongs to, so render() can reuse the last frame buffer.
+    """
+    lines = self.lines
+    # Same frame times moviepy asks for.
+    times = numpy.arange(0, self.duration, 1/self.fps)
+    frames = len(times)
+
+    shows = numpy.array([l.show for l in lines], dtype = float)
+    hides = numpy.array([l.hide for l in lines], dtype = float)
+    # A line is visible for show <= t < hide
+    first = numpy.searchsorted(times, shows, "left")
+    last = numpy.searchsorted(times, hides, "left")
+    last = numpy.maximum(first, last)
+
+    visible = numpy.zeros(frames + 1, dtype = numpy.int32)
+    numpy.add.at(visible, first, 1)
+    numpy.add.at(visible, last, -1)
+    maxvisible = max(int(numpy.cumsum(visible).max(initial = 0)), 1)
+
+    timeline = {
+      "times": times,
+      "events": numpy.unique(numpy.concatenate((first, last))),
+      "lines": numpy.full((frames, maxvisible), -1, dtype = numpy.int32),
+      "wipes": numpy.zeros((frames, maxvisible), dtype = numpy.int32),
+      "cues": numpy.full((frames, maxvisible), -1, dtype = numpy.int32),
+      "plug": numpy.zeros(frames, dtype = bool)
+    }
+    if not self.suppress_plug:
+      timeline["plug"] = times > hides.max(initial = 0)
+
+    count = numpy.zeros(frames, dtype = numpy.int32)
+    for line_id, line in enumerate(lines):
+      rows = numpy.arange(first[line_id], last[line_id])
+      if len(rows) == 0:
+        continue
+      cols = count[rows]
+      count[rows] += 1
+      timeline["lines"][rows, cols] = line_id
+      t = times[rows]
+
+      if line.display == Display.PAUSE:
+        percentage = (t - line.show)/(line.hide - line.show)
+        timeline["wipes"][rows, cols] = (self.maxLineLength * percentage).astype(numpy.int32)
+        continue
+      if line.display == Display.PEEK:
+        continue
+
+      if not line.parts:
+        percentage = self.wipePercentage(t, line.start, line.end)
+        percentage[t <= line.start] = 0
+        width = self.metrics.width(line.text)
+        timeline["wipes"][rows, cols] = (width * percentage).astype(numpy.int32)
+      else:
+        offsets = self.metrics.offsets([part.text for part in line.parts])
+        wipe = numpy.zeros(len(rows))
+        for idx, part in enumerate(line.parts):
+          percentage = self.wipePercentage(t, part.start, part.end)
+          wipe += (offsets[idx + 1] - offsets[idx]) * percentage
+        wipe[t <= line.start] = 0
+        timeline["wipes"][rows, cols] = wipe.astype(numpy.int32)
+
+      if line.display == Display.CUE:
+        percentage = numpy.clip((line.start - t)/self.cue_length, None, 1)
+        cue = (self.lineheight * percentage).astype(numpy.int32)
+        cue[t > line.start] = -1
+        timeline["cues"][rows, cols] = cue
+
+    # Static spans. With --debug every frame shows a different time.
+    static = numpy.zeros(frames, dtype = bool)
+    if not self.debug and frames > 1:
+      static[1:] = ((timeline["lines"][1:] == timeline["lines"][:-1]).all(1)
+        & (timeline["wipes"][1:] == timeline["wipes"][:-1]).all(1)
+        & (timeline["cues"][1:] == timeline["cues"][:-1]).all(1)
+        & (timeline["plug"][1:] == timeline["plug"][:-1]))
+    timeline["static"] = static
+    timeline["spans"] = numpy.maximum.accumulate(numpy.where(static, 0, numpy.arange(frames)))
+
+    self.timeline = timeline
+    self.framebuffer = None
+    self.lastframe = None
+    self.lastspan = -1
+    self.reusedframes = 0
+    self.copiedbytes = 0
+    self.copiedframes = 0
+
+  def vfrParams(self, filterfile, first = 0, last = None):
+    """
+      ffmpeg output parameters for variable frame rate output. B-frames
+      are turned off, they mess up the decoding timestamps across the
+      gaps, which breaks the duration and joining segments.
+    """
+    self.writeVfrFilter(filterfile, first, last)
+    return ["-filter_script:v", filterfile, "-vsync", "vfr", "-bf", "0"]
+
+  def writeVfrFilter(self, filename, first = 0, last = None):
+    """
+      Write an ffmpeg filter script dropping the frames of the static
+      spans, so the encoder only sees the first frame of each span. The
+      remaining frames keep their timestamps. The first and the last
+      frame are always kept to preserve the length of the movie.
+    """
+    static = self.timeline["static"][first:last].copy()
+    static[0] = False
+    static[-1] = False
+    # Start and end of every run of static frames
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], static.astype(numpy.int8), [0]))))
+    ranges = ["between(n,%d,%d)" % (a, b - 1) for a, b in zip(edges[::2], edges[1::2])]
+    with open(filename, "w") as f:
+      f.write("select='not(" + ("+".join(ranges) or "0") + ")'")
+    return filename
+
+  def wipePercentage(self, t, start, end):
+    """
+      Vectorized highlight progress of a line or part for the times t,
+      clipped to 0..1.
+    """
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+      percentage = (t - start)/(end - start - 1/self.fps)
+    return numpy.clip(numpy.nan_to_num(percentage, nan = 0, posinf = 1, neginf = 0), 0, 1)
 
   def layout(self):
     """
       Layout the movie. Determine what to show where and when.
     """
+    maxslots = self.layoutTiming()
+
+    # Determine optimal font size
+    # Step 3: Line length
+    # Measure the lines in the reference font size. The width grows with
+    # the font size, so that's the size the longest line fills
+    # maxLineLength at.
+    self.fontSize = self.referenceFontSize
+    self.updateFont()
+    longest = 0
+    for l in self.lines:
+      if l.display == Display.PEEK or l.display == Display.PAUSE: continue
+      longest = max(longest, self.metrics.width(l.text))
+    fontSize = self.referenceFontSize * self.maxLineLength/longest
+
+    # Step 4: Number of lines
+    # The slots take maxslots lines and half a line between each slot,
+    # so maxslots + (maxslots - 1)/2 lines. Which is 1.5 * maxslots - 0.5
+    # If that's heigher than our screen, the lineheight decides the size.
+    slotlines = 1.5 * maxslots - 0.5
+    fontSize = min(fontSize, self.referenceFontSize * self.height/(self.lineheight * slotlines))
+    self.fontSize = int(fontSize)
+    # This will save the actual lineheight in px to self.lineheight
+    self.updateFont()
+    # Line heights are rounded, so make sure we really fit.
+    while self.fontSize > 1 and self.lineheight * slotlines > self.height:
+      self.fontSize -= 1
+      self.updateFont()
+
+    # Step 5: Slot positions
+    # Calculate the positions of the slots, now that we know how many
+    # lines we need.
+    top = (self.height - self.lineheight * (1.5 * maxslots - 0.5))/2
+    for i in range(maxslots):
+      self.slotpositions.append(top)
+      top += 1.5 * self.lineheight
+
+    # Step 6: Precompute the per frame timeline
+    self.buildTimeline()
+
+  def layoutTiming(self):
+    """
+      The timing part of the layout, which needs no fonts: when to show
+      the cards, pauses, cues and peeks, and the lines with their
+      timings. Returns the number of slots needed.
+    """
     #Let's count lines we use, to see how many we need in the end.
     maxslots = 0
 
     # Determine the length of the pre and post gaps of every card
     cursor = 0
-    for card_idx in range(len(self.data["cards"])):
-      timestamps = self.data["timestamps"][card_idx]
-      start = timestamps[0]
-      end = timestamps[1]
-      self.data["pre_gaps"].append(start - cursor)
-      cursor = end
-    # Post = pre[1:] and the last element set to "infinity"
-    self.data["post_gaps"] = self.data["pre_gaps"][1:]
-    self.data["post_gaps"].append(self.data["duration"] - end)
+    for card in self.cards:
+      card.pre_gap = card.start - cursor
+      cursor = card.end
+    # Post = the next pre gap, and up to the end for the last card
+    for card, nextcard in zip(self.cards, self.cards[1:]):
+      card.post_gap = nextcard.pre_gap
+    self.cards[-1].post_gap = self.duration - cursor
 
+    # Pause bars and the indices of the cards, in order
     layout = []
     # Step 1: Figure out card display times, peeks, cues and pauses
     lastEnd = 0;
-    for card_idx in range(len(self.data["cards"])):
-      card = self.data["cards"][card_idx]
-      timestamps = self.data["timestamps"][card_idx]
-      start = timestamps[0]
-      end = timestamps[1]
+    for card_idx, card in enumerate(self.cards):
+      start = card.start
+      end = card.end
       show = start
-      hide = end
-      pre_gap =  self.data["pre_gaps"][card_idx]
-      post_gap =  self.data["post_gaps"][card_idx]
+      pre_gap = card.pre_gap
       
       # If we have a long gap before this card, fit in a pause.
       # Adjust the "show" value accordingly.
       if pre_gap > self.pause_threshold:
-        layout.append({
-          "display": "pause",
-          "show": lastEnd,
-          "hide": start - self.pause_gap
-        })
+        layout.append(Line(Display.PAUSE, 0, lastEnd, start - self.pause_gap))
         show = start - self.pause_gap
       lastEnd = end
       
@@ -269,64 +1799,30 @@ class KaraOkay:
         show = start - self.show_before
       else: 
         show = start - pre_gap
+      card.show = show
+      card.hide = end
       
-      display_type = "regular"
-      if self.data["pre_gaps"][card_idx] > self.cue_length:
-        display_type = "cue"
+      card.display = Display.REGULAR
+      if pre_gap > self.cue_length:
+        card.display = Display.CUE
         
-      peek = False
-      slots = len(card)
-      if post_gap < self.peek_threshold:
-        peek = True
+      card.peek = False
+      slots = len(card.lines)
+      if card.post_gap < self.peek_threshold:
+        card.peek = True
         slots += 1
       
       if slots > maxslots:
         maxslots = slots
 
-      layout.append({ 
-        "display": display_type,
-        "card": card_idx,
-        "show": show,
-        "hide": hide,
-        "peek": peek
-      })      
+      layout.append(card_idx)
 
     
     # Step 2: Break the layout down to lines, assign them to slots
     # and figure out the timings of each lines.
     # Moved to its own method, this one is too long anyway ...
     self.layoutlines(layout, maxslots); 
-
-    # Determine optimal font size
-    # Step 3: Line length
-    longest = pygame.Rect(0,0,0,0)
-    for l in self.data["lines"]:
-      if l["display"] == "peek" or l["display"] == "pause": continue
-      renderedLine = self.font.render(l["text"], True, self.fontcolor)
-      renderedLineRect = renderedLine.get_rect()
-      if renderedLineRect.w > longest.w:
-        longest = renderedLineRect
-    self.fontSize = int(self.referenceFontSize * self.maxLineLength/longest.w)
-    # This will save the actual lineheight in px to self.lineheight
-    self.updateFont()
-    
-    # Step 4: Number of lines
-    # We assume a blank half an line on bottom and top, and half line
-    # between each slot, so maxslots + 1 + (maxslots -1)/2 lines.
-    # Which is 1.5 * maxslots - 0.5
-    # If that's heigher than our screen, adjust lineheight accordingly
-    slotsheight = self.lineheight * 1.5 * maxslots - 0.5
-    if slotsheight > self.height:
-      self.fontSize = int(self.fontSize * self.height/slotsheight)
-      self.updateFont()    
-    
-    # Step 5: Slot positions 
-    # Calculate the positions of the slots, now that we know how many
-    # lines we need.
-    top = (self.height - (self.lineheight * 1.5 * maxslots - 0.5))/2
-    for i in range(maxslots):
-      self.slotpositions.append(top)
-      top += 1.5 * self.lineheight
+    return maxslots
 
   def layoutlines(self, layout, maxslots):
     """
@@ -334,39 +1830,36 @@ class KaraOkay:
       because of "intra" timings, which are timestamps withing a line.
     """
     for item in layout:
-      if "pause" == item["display"]:
-        item["slot"] = int((maxslots-1)/2)
-        self.data["lines"].append(item) 
+      if isinstance(item, Line):
+        # A pause bar
+        item.slot = int((maxslots-1)/2)
+        self.lines.append(item) 
         continue
           
-      card = self.data["cards"][item["card"]]
-      timestamps = self.data["timestamps"][item["card"]]
-      start = timestamps[0]
-      end = timestamps[1]
+      card = self.cards[item]
+      start = card.start
+      end = card.end
       
       # Collect all possible timestamps, which are start of line, end
       # of line and all timestamps within a line.
       # Not all of them may be defined, so we just note down a "?" and
       # fix it up later.
       timestamps = []
-      for line_idx in range(len(card)):
-        line = card[line_idx]
+      for line_idx in range(len(card.lines)):
+        tokens = card.lines[line_idx]
         
-        start_match = re.match("\[(.*?)\]", line)
         ts = "?"
-        if start_match:
-          ts = float(start_match.group(1))
+        if tokens[0].kind == "timestamp":
+          ts = tokens[0].value
         timestamps.append(["start", ts, line_idx])
         
-        intra_search = re.finditer(".\[(.*?)\].", line)
-        for intra_match in intra_search:
-          ts = float(intra_match.group(1))
-          timestamps.append(["intra", ts, line_idx])
+        for token in tokens[1:-1]:
+          if token.kind == "timestamp":
+            timestamps.append(["intra", token.value, line_idx])
 
-        end_match = re.match(".*\[" + self.secondsRegex + "\]$", line)
         ts = "?"
-        if end_match:
-          ts = float(end_match.group(1))
+        if tokens[-1].kind == "timestamp":
+          ts = tokens[-1].value
         timestamps.append(["end", ts, line_idx])
 
       # Fix-up start and end of the card
@@ -445,194 +1938,1334 @@ class KaraOkay:
         if ts[0] == "intra":
           timestamp_lines[ts[2]]["intra"].append(ts[1])
 
-      for line_idx in range(len(card)):
-        # We may have a gap between the ending of the last line and
-        # the start of this one. On the first line of the card this
-        # was taken care of in self.layout(), evaluating the respective
-        # pre gap.
-        if (line_idx > 0 and  timestamp_lines[line_idx]["start"] - timestamp_lines[line_idx - 1]["end"] > self.cue_length):
-          display_type = "cue"
-        
-        clean_and_split_line = self.clean_and_split_line(card[line_idx])
+      display = card.display
+      for line_idx in range(len(card.lines)):
+        clean_and_split_line = self.clean_and_split_line(card.lines[line_idx])
         cleaned_line = clean_and_split_line["line"]
         line_parts = clean_and_split_line["parts"]
-        line_def = {
-          "text": cleaned_line,
-          "slot": line_idx,
-          "display": item["display"],
-          "show": item["show"],
-          "hide": item["hide"],
-          "start": timestamp_lines[line_idx]["start"],
-          "end": timestamp_lines[line_idx]["end"],
-          "parts": False,
-          "card": item["card"]
-        }
+        line = Line(display, line_idx, card.show, card.hide, cleaned_line,
+          timestamp_lines[line_idx]["start"], timestamp_lines[line_idx]["end"], card = item)
         if len(line_parts) > 1:
-          line_def["parts"] = []
           for i in range(len(line_parts)):
-            line_def["parts"].append({
-              "text": line_parts[i],
-              "slot": line_idx,
-              "start": timestamp_lines[line_idx]["intra"][i],
-              "end": timestamp_lines[line_idx]["intra"][i + 1]
-            })
-        self.data["lines"].append(line_def)
-        item["display"] = "regular"
-
-      if item["peek"] and not item["card"] == len(self.data["cards"]) - 1:
+            line.parts.append(Part(line_parts[i],
+              timestamp_lines[line_idx]["intra"][i],
+              timestamp_lines[line_idx]["intra"][i + 1]))
+        self.lines.append(line)
+        display = Display.REGULAR
+
+      if card.peek and not item == len(self.cards) - 1:
                           # never after the last card
-        preek_line =  clean_and_split_line = self.clean_and_split_line(self.data["cards"][item["card"] + 1][0])["line"]
-        self.data["lines"].append({
-          "text": preek_line,
-          "slot": line_idx + 1,
-          "display": "peek",
-          "show": item["show"],
-          "hide": item["hide"],
-        }) 
+        peek_line = self.clean_and_split_line(self.cards[item + 1].lines[0])["line"]
+        self.lines.append(Line(Display.PEEK, line_idx + 1, card.show, card.hide, peek_line))
 
-  def clean_and_split_line(self, text):
+  def clean_and_split_line(self, tokens):
     """
       Get rid of any timestamps in the line, but return the parts of
       breaking the the line at intra timestamps
     """
-    text = re.sub("\[.*?\]", "[", text)
-    if text[0] == "[":
-      text = text[1:]
-    if text[len(text) - 1] == "[":
-      text = text[:-1]
-    parts = text.split("[")
-    text = re.sub("\[", "", text)
-    return {"line": text, "parts": parts}
+    parts = [""]
+    for token in tokens:
+      if token.kind == "timestamp":
+        parts.append("")
+      else:
+        parts[-1] += token.value
+    if tokens[0].kind == "timestamp":
+      del parts[0]
+    if tokens[-1].kind == "timestamp":
+      del parts[-1]
+    return {"line": "".join(parts), "parts": parts}
     
+  def renderText(self, text, color):
+    """
+      Return a surface with the text rendered in the current font.
+    """
+    return self.textcache.get(self.font, self.fontSize, text, color)
+
+  def titleCard(self, text):
+    """
+      A frame showing text centered on the background, e.g. between the
+      songs of a playlist. "|" breaks lines. The font size is chosen
+      like for the lyrics, but never bigger than the reference size.
+    """
+    lines = [line.strip() for line in text.split("|")]
+    self.fontSize = self.referenceFontSize
+    self.updateFont()
+    longest = max(max(self.metrics.width(line) for line in lines), 1)
+    slotlines = 1.5 * len(lines) - 0.5
+    self.fontSize = int(min(self.referenceFontSize,
+      self.referenceFontSize * self.maxLineLength/longest,
+      self.referenceFontSize * self.height/(self.lineheight * slotlines)))
+    self.updateFont()
+
+    self.drawBackground()
+    top = (self.height - self.lineheight * slotlines)/2
+    for line in lines:
+      surface = self.renderText(line, self.fontcolor)
+      rect = surface.get_rect()
+      rect.centerx = self.width/2
+      rect.top = top
+      self.screen.blit(surface, rect)
+      top += 1.5 * self.lineheight
+    return self.copyFrame()
+
   def drawBackground(self):
     rect = pygame.Rect(0, 0, self.width, self.height)
     pygame.draw.rect(self.screen, self.bgcolor, rect)
 
   def parse(self, filename):
     """
-      Parse the cards and give helpful errors if something's wrong.
-      Additionally timestamps within text are rewritten to be easily
-      handled in the subsequent layout step.
+      Parse the cards and give helpful errors if something's wrong. The
+      file is read line by line. Cards are stored as a list of lines,
+      each a list of its "text" and "timestamp" tokens, which is what
+      the subsequent layout step works on.
     """
-    # Keep track of the line we're processing
-    linecount = 0
-    
-    # Read the file contents into memory
-    txt = self.file_get_contents(filename)
-    
-    # Parse the configuration line, which is the first line of the file
-    cards = txt.split("--")
-    d = re.match("#\s+Duration:\s" + self.tsRegex, cards[0])
-    if d:
-      d_sec = d.group(2)
-      d_min = d.group(1)
-      duration = float(d_sec);
-      if (d_min != None):
-        duration += float(d_min)*60
-      self.data["duration"] = duration
-    else:
-      raise ParserError(linecount + 1, "Failed to parse duration timestamp.")      
-   
-    del cards[0] # Get rid of the "configuration card"
-      
-    # Iterate over the cards
-    for card in cards:
-      # Strip whitespace from all the lines on the card
-      lines = list(map(lambda i: i.strip(), card.split("\n")))
-      if '' == lines[-1]:
-        del lines[-1] # There's certainly a \n afer the last line of the
-                      # card, which yields an empty last list item.
-      ts_match = re.match("\s*" + self.tsRegex + "\s*-\s*" + self.tsRegex, lines[0])
-
-      if ts_match:
-        start = float(ts_match.group(2))
-        if (ts_match.group(1) != None):
-          start += float(ts_match.group(1)) * 60        
-        end = float(ts_match.group(4))
-        if (ts_match.group(3) != None):
-          end += float(ts_match.group(3)) * 60    
-        self.data["timestamps"].append((start,end))
-      
-        del lines[0] # Get rid of the seperator line
-        linecount += 1 # + 1 for the seperator line
-        
-        # Scan the lines for intra line timestamps and check them for
-        # sensible timings.
-        for line_idx in range(len(lines)):
-          linecount += 1
-          line = lines[line_idx]
+    cards = self.cards
+    header = None
+    duration = None
+
+    def check(header):
+      # The card and its last line must not be empty.
+      if header is None:
+        return
+      lines = cards[-1].lines
+      if not lines:
+        raise ParserError(header.line, "Card without lyrics", header.col)
+      if not any(token.kind == "text" for token in lines[-1]):
+        raise ParserError(lines[-1][0].line, "Line without lyrics", lines[-1][0].col)
+
+    with open(filename) as f:
+      for token in tokenize(f):
+        if token.kind == "duration":
+          duration = token.value
+          continue
+
+        if token.kind == "card":
+          check(header)
+          header = token
+          cards.append(Card(*token.value))
+          continue
+
+        start, end = header.value
+        lines = cards[-1].lines
+        if not lines or lines[-1][-1].line != token.line:
+          if lines:
+            check(header)
+          lines.append([])
           last_ts = start
-          intra_search = re.finditer("\[" + self.tsRegex + "\]", line)
-          for intra_match in intra_search:
-            secs = float(intra_match.group(2))
-            if (intra_match.group(1) != None):
-              secs += float(intra_match.group(1)) * 60   
-            if not last_ts <= secs <= end:
-              raise ParserError(linecount + 1, "Timestamp out of bounds:'" + line + "'")
-            last_ts = secs 
-            # Replace the timestamps with their parsed version.
-            lines[line_idx] = lines[line_idx].replace(intra_match.group(0), "[" + str(secs) + "]")
-        self.data["cards"].append(lines)
-      else:
-        raise ParserError(linecount + 1, "No timestamps")
+        # Timestamps must be in order within a line, and within the card.
+        if token.kind == "timestamp":
+          if not last_ts <= token.value <= end:
+            raise ParserError(token.line, "Timestamp out of bounds", token.col)
+          last_ts = token.value
+        lines[-1].append(token)
+
+    if header is None:
+      raise ParserError(1, "No cards found")
+    check(header)
+
+    # Without a duration line, the movie lasts as long as the audio.
+    if duration is None:
+      duration = self.audioduration
+    if duration is None:
+      raise ParserError(1, "No duration given, nor an audio file to take it from")
+    self.duration = duration
       
   def updateFont(self):
     """ 
       This not only updates the font definition in use, but also
       recalculates the lineheight.
     """
-    self.font = pygame.font.Font(self.fontfile, self.fontSize)
-    text = self.font.render("a", True, (0,0,255))
-    self.lineheight = text.get_rect().h
+    key = (self.fontfile, self.fontSize)
+    if key not in KaraOkay.fonts:
+      pygame.font.init()
+      if len(KaraOkay.fonts) >= KaraOkay.maxfonts:
+        KaraOkay.fonts.clear()
+      KaraOkay.fonts[key] = TextMetrics(pygame.font.Font(self.fontfile, self.fontSize))
+    if getattr(self, "metrics", None) is not KaraOkay.fonts[key]:
+      # The surfaces of the previous font aren't asked for again.
+      self.textcache.clear()
+    self.metrics = KaraOkay.fonts[key]
+    self.font = self.metrics.font
+    self.lineheight = self.metrics.height
 
-  # Hello php-folks!
-  def file_get_contents(self, filename):
-    """ Return the contents of the given file in a single string. """
-    with open(filename) as f:
-      return f.read()
-        
   def debug_output(self):
     """
       Print a parsed version of the input file to stdout.
     """
-    print("# Duration: " + str(self.data["duration"]))
+    print("# Duration: " + str(self.duration))
     lastcard = -1
-    for l in self.data["lines"]:
-      if l["display"] == "peek" or l["display"] == "pause": continue
-      if lastcard != l["card"]:
-        timestamps = self.data["timestamps"][l["card"]]
-        print("-- %.2f - %.2f" % (timestamps[0], timestamps[1]))
-      if l["parts"] == False:
-        start = "%.2f" % l["start"]
-        end = "%.2f" % l["end"]
-        print("[" + start + "]" + l["text"] + "[" + end + "]")
+    for l in self.lines:
+      if l.display == Display.PEEK or l.display == Display.PAUSE: continue
+      if lastcard != l.card:
+        card = self.cards[l.card]
+        print("-- %.2f - %.2f" % (card.start, card.end))
+      if not l.parts:
+        start = "%.2f" % l.start
+        end = "%.2f" % l.end
+        print("[" + start + "]" + l.text + "[" + end + "]")
       else:
-        start = "%.2f" % l["parts"][0]["start"]
+        start = "%.2f" % l.parts[0].start
         outstr = "[" + start + "]"
-        for p in l["parts"]:
-          end = "%.2f" % p["end"]
-          outstr += p["text"] + "[" + end + "]"
+        for p in l.parts:
+          end = "%.2f" % p.end
+          outstr += p.text + "[" + end + "]"
         print(outstr)
-      lastcard = l["card"]
+      lastcard = l.card
 
   def show_plug(self):
-      text = self.font.render("kara-okay.github.io", True, self.peekcolor)
+      text = self.renderText("kara-okay.github.io", self.peekcolor)
       textrect = text.get_rect()
       textrect.midbottom = (self.width/2, self.height - self.lineheight * 0.5) 
       self.screen.blit(text, textrect)
 
+  def writeAss(self, filename):
+    """
+      Write the layout as ASS subtitles. Lines are placed at their slots
+      and highlighted using karaoke tags, a \\kf sweep per part. Pause
+      bars and cue markers are drawn as shapes, animated with \\t.
+    """
+    fontname = fontName(self.fontfile)
+
+    def color(rgb):
+      return "&H%02X%02X%02X&" % (rgb[2], rgb[1], rgb[0])
+
+    def timestamp(seconds):
+      cs = int(round(seconds * 100))
+      return "%d:%02d:%02d.%02d" % (cs // 360000, cs // 6000 % 60, cs // 100 % 60, cs % 100)
+
+    def escape(text):
+      # Braces start override blocks and there's no escaping them.
+      return text.replace("\\", "/").replace("{", "(").replace("}", ")")
+
+    def dialogue(layer, start, end, style, text):
+      return "Dialogue: %d,%s,%s,%s,,0,0,0,,%s\n" % (layer, timestamp(start), timestamp(end), style, text)
+
+    def box(w, h):
+      return "m 0 0 l %d 0 %d %d 0 %d" % (w, w, h, h)
+
+    style = "Style: %s,%s,%d,%s,%s,&H0,&H0,0,0,0,0,100,100,0,0,1,0,0,8,0,0,0,1\n"
+    out = "[Script Info]\nScriptType: v4.00+\nPlayResX: %d\nPlayResY: %d\nWrapStyle: 2\n\n" % (self.width, self.height)
+    out += "[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n"
+    # Karaoke goes from the secondary to the primary color
+    out += style % ("Lyrics", fontname, self.lineheight, color(self.hicolor)[:-1], color(self.fontcolor)[:-1])
+    out += style % ("Peek", fontname, self.lineheight, color(self.peekcolor)[:-1], color(self.peekcolor)[:-1])
+    out += "\n[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+
+    last_hide = 0
+    for line in self.lines:
+      last_hide = max(last_hide, line.hide)
+      top = self.slotpositions[line.slot]
+
+      if line.display == Display.PAUSE:
+        left = int(self.width/2 - self.maxLineLength/2)
+        w, h = int(self.maxLineLength), self.lineheight
+        out += dialogue(0, line.show, line.hide, "Lyrics",
+          "{\\an7\\pos(%d,%d)\\1c%s\\p1}%s" % (left, top, color(self.fontcolor), box(w, h)))
+        out += dialogue(1, line.show, line.hide, "Lyrics",
+          "{\\an7\\pos(%d,%d)\\1c%s\\clip(%d,%d,%d,%d)\\t(\\clip(%d,%d,%d,%d))\\p1}%s" % (
+            left, top, color(self.hicolor), left, top, left, top + h,
+            left, top, left + w, top + h, box(w, h)))
+        continue
+
+      if line.display == Display.PEEK:
+        out += dialogue(0, line.show, line.hide, "Peek",
+          "{\\an8\\pos(%d,%d)}%s" % (self.width/2, top, escape(line.text)))
+        continue
+
+      parts = line.parts or [line]
+      text = "{\\an8\\pos(%d,%d)}" % (self.width/2, top)
+      cursor = int(round(line.show * 100))
+      for part in parts:
+        start = max(int(round(part.start * 100)), cursor)
+        end = max(int(round(part.end * 100)), start)
+        if start > cursor:
+          text += "{\\k%d}" % (start - cursor)
+        text += "{\\kf%d}%s" % (end - start, escape(part.text))
+        cursor = end
+      out += dialogue(0, line.show, line.hide, "Lyrics", text)
+
+      if line.display == Display.CUE and line.start > line.show:
+        left = self.width/2 - self.metrics.width(line.text)/2
+        scale = min((line.start - line.show) / self.cue_length, 1) * 100
+        shrink = int(max(line.start - self.cue_length - line.show, 0) * 1000)
+        out += dialogue(0, line.show, line.start, "Lyrics",
+          "{\\an9\\pos(%d,%d)\\1c%s\\fscx%d\\t(%d,%d,\\fscx0)\\p1}%s" % (
+            left, top, color(self.fontcolor), scale, shrink,
+            int((line.start - line.show) * 1000), box(self.lineheight, self.lineheight)))
+
+    if not self.suppress_plug and last_hide < self.duration:
+      out += dialogue(0, last_hide, self.duration, "Peek",
+        "{\\an2\\pos(%d,%d)}kara-okay.github.io" % (self.width/2, self.height - self.lineheight * 0.5))
+
+    with open(filename, "w", encoding = "utf-8") as f:
+      f.write(out)
+
+  def renderSubtitles(self, outfile, audiofile):
+    """
+      Let ffmpeg produce the movie from the ASS subtitles, either burnt
+      into a plain background or muxed as a subtitle track. Soft
+      subtitles in mp4 files lose the karaoke highlighting, use a .mkv
+      movie to keep it.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+      assfile = self.assfile or os.path.join(tmpdir, "lyrics.ass")
+      self.writeAss(assfile)
+
+      background = "color=c=0x%02x%02x%02x:s=%dx%d:r=%d:d=%s" % (
+        self.bgcolor + (self.width, self.height, self.fps, self.duration))
+      cmd = [ffmpegBinary(), "-y", "-loglevel", "error", "-f", "lavfi", "-i", background]
+      maps = ["-map", "0:v"]
+      if audiofile:
+        cmd += ["-i", audiofile]
+        maps += ["-map", "1:a", "-c:a", self.audioCodec(outfile)] + self.durationParams()
+      if self.subtitles == "burn":
+        maps += ["-vf", "ass=%s:fontsdir=%s" % (filterPath(assfile), filterPath(os.path.dirname(self.fontfile)))]
+      else:
+        cmd += ["-i", assfile]
+        maps += ["-map", "%d:s" % (2 if audiofile else 1),
+          "-c:s", "mov_text" if outfile.endswith((".mp4", ".mov")) else "ass"]
+      cmd += maps + ["-c:v", self.encoder["codec"]]
+      if self.encoder["preset"] and self.encoder["codec"] in ("libx264", "libx265"):
+        cmd += ["-preset", self.encoder["preset"]]
+      if self.encoder["threads"]:
+        cmd += ["-threads", str(self.encoder["threads"])]
+      cmd += self.encoderParams() + ["-pix_fmt", "yuv420p", outfile]
+
+      proc = subprocess.run(cmd, stderr = subprocess.PIPE)
+      if proc.returncode != 0:
+        sys.exit("Failed to render the subtitles: " + proc.stderr.decode(errors = "replace"))
+
+def seconds(match, group = 1):
+  """
+    Seconds of a timestamp matched by tsRegex, starting at group.
+  """
+  secs = float(match.group(group + 1))
+  if match.group(group) != None:
+    secs += float(match.group(group)) * 60
+  return secs
+
+def tokenize(lines):
+  """
+    Split the lines of a kok file into tokens, in a single pass: the
+    "duration" given in the first line, "card" headers with the start
+    and end of the card as value and the lyrics of the cards as "text"
+    and "timestamp" tokens. Lines are stripped, blank lines and
+    anything before the first card is skipped. The duration line is
+    optional.
+  """
+  incard = False
+  for lineno, line in enumerate(lines, 1):
+    if lineno == 1 and line.startswith("#"):
+      match = durationPattern.match(line)
+      if not match:
+        raise ParserError(1, "Failed to parse duration timestamp.")
+      yield Token("duration", seconds(match), 1, 1)
+      continue
+
+    text = line.strip()
+    if text == "":
+      continue
+    col = len(line) - len(line.lstrip()) + 1
+
+    if text.startswith("--"):
+      match = cardPattern.match(text)
+      if not match:
+        raise ParserError(lineno, "No timestamps", col)
+      yield Token("card", (seconds(match, 1), seconds(match, 3)), lineno, col)
+      incard = True
+      continue
+    if not incard:
+      continue
+
+    pos = 0
+    for match in bracketPattern.finditer(text):
+      if match.start() > pos:
+        yield textToken(text[pos:match.start()], lineno, col + pos)
+      ts = timestampPattern.fullmatch(match.group(1))
+      if not ts:
+        raise ParserError(lineno, "Invalid timestamp '" + match.group(0) + "'", col + match.start())
+      yield Token("timestamp", seconds(ts), lineno, col + match.start())
+      pos = match.end()
+    if pos < len(text):
+      yield textToken(text[pos:], lineno, col + pos)
+
+def textToken(text, line, col):
+  if "[" in text:
+    raise ParserError(line, "Unclosed timestamp", col + text.index("["))
+  return Token("text", text, line, col)
+
+def fontName(fontfile):
+  """
+    Full name of a TrueType or OpenType font, read from its name table.
+    That's what libass reliably selects a font by. Falls back to the file
+    name.
+  """
+  try:
+    with open(fontfile, "rb") as f:
+      data = f.read()
+    tables = struct.unpack(">H", data[4:6])[0]
+    for i in range(tables):
+      tag, checksum, offset, length = struct.unpack(">4sIII", data[12 + 16 * i:28 + 16 * i])
+      if tag != b"name":
+        continue
+      count, strings = struct.unpack(">HH", data[offset + 2:offset + 6])
+      names = {}
+      for j in range(count):
+        record = offset + 6 + 12 * j
+        platform, encoding, language, nameid, size, start = struct.unpack(">HHHHHH", data[record:record + 12])
+        raw = data[offset + strings + start:offset + strings + start + size]
+        if platform == 3:
+          names.setdefault(nameid, raw.decode("utf-16-be"))
+        elif platform == 1:
+          names.setdefault(nameid, raw.decode("latin-1"))
+      if 4 in names or 1 in names:
+        return names.get(4, names.get(1))
+  except (IOError, struct.error, UnicodeDecodeError):
+    pass
+  return os.path.splitext(os.path.basename(fontfile))[0]
+
+def filterPath(path):
+  """
+    Escape a path for use as an option value in an ffmpeg filter graph.
+  """
+  return path.replace("\\", "/").replace(":", "\\:").replace("'", "\\'")
+
+def renderSegment(job):
+  """
+    Entry point of the worker processes of KaraOkay.renderSegments().
+  """
+  options, first, last, segmentfile = job
+  app = KaraOkay(**options)
+  app.prepare()
+  app.writeFrames(segmentfile, first, last)
+  return first, last
+
+def ffmpegBinary():
+  """
+    The ffmpeg executable to use. Like moviepy, we take FFMPEG_BINARY
+    from the environment or the one shipped with imageio-ffmpeg, and
+    fall back to the one on the PATH.
+  """
+  binary = os.environ.get("FFMPEG_BINARY", "ffmpeg-imageio")
+  if binary == "ffmpeg-imageio":
+    try:
+      import imageio_ffmpeg
+      binary = imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+      binary = "ffmpeg"
+  return binary
+
+def probeAudio(filename, probes = {}):
+  """
+    Codecs of the audio streams and duration in seconds of an audio
+    file, as reported by ffmpeg without decoding it. The duration is
+    None if unknown. Remembered per path, size and modification time.
+  """
+  stat = os.stat(filename)
+  key = (filename, stat.st_size, stat.st_mtime)
+  if key not in probes:
+    # Without an output file ffmpeg just prints what it found and fails.
+    proc = subprocess.run([ffmpegBinary(), "-hide_banner", "-i", filename],
+      stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    info = proc.stderr.decode(errors = "replace")
+    match = re.search(r"Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)", info)
+    duration = None
+    if match:
+      hours, minutes, secs = match.groups()
+      duration = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+    codecs = re.findall(r"Stream #\d+:\d+.*?: Audio: (\w+)", info)
+    probes[key] = {"codecs": codecs, "duration": duration}
+  return probes[key]
+
+def parseSize(size):
+  """
+    Parse a size given as WIDTHxHEIGHT on the command line.
+  """
+  match = re.match(r"^(\d+)x(\d+)$", size)
+  if not match:
+    raise argparse.ArgumentTypeError("Size must be given as WIDTHxHEIGHT, e.g. 1920x1080.")
+  width, height = int(match.group(1)), int(match.group(2))
+  if width % 2 or height % 2 or width == 0 or height == 0:
+    raise argparse.ArgumentTypeError("Width and height must be even numbers.")
+  return width, height
+
+def parseRenditions(value):
+  """
+    Parse renditions given on the command line as comma separated
+    WIDTHxHEIGHT, each optionally followed by :CODEC. All must have the
+    same aspect ratio, as they're scaled from the same frames.
+  """
+  renditions = []
+  for item in value.split(","):
+    size, sep, codec = item.strip().partition(":")
+    width, height = parseSize(size)
+    renditions.append((width, height, codec or None))
+  width, height, codec = renditions[0]
+  for other in renditions[1:]:
+    if other[0] * height != width * other[1]:
+      raise argparse.ArgumentTypeError("All renditions must have the same aspect ratio.")
+  return renditions
+
+def fileHash(filename, hashes = {}):
+  """
+    SHA-256 of the contents of a file, remembered per path, size and
+    modification time.
+  """
+  stat = os.stat(filename)
+  key = (filename, stat.st_size, stat.st_mtime)
+  if key not in hashes:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 20), b""):
+        digest.update(chunk)
+    hashes[key] = digest.hexdigest()
+  return hashes[key]
+
+def findSongs(source):
+  """
+    Collect the songs for batch mode. source may be a directory or a glob
+    pattern matching .kok files, or a manifest file listing one song per
+    line as tab separated kok file, audio file and movie file, the
+    latter two being optional. Returns (kokfile, audiofile, outfile)
+    tuples. If not given in a manifest, audio files are looked up next
+    to the kok file, with the same name.
+  """
+  if os.path.isdir(source):
+    kokfiles = sorted(glob.glob(os.path.join(source, "*.kok")))
+  elif isfile(source) and not source.endswith(".kok"):
+    songs = []
+    basedir = os.path.dirname(abspath(source))
+    with open(source) as f:
+      for line in f:
+        if line.strip() == "" or line.startswith("#"):
+          continue
+        fields = [os.path.join(basedir, field.strip()) if field.strip() else None
+          for field in line.rstrip("\n").split("\t")]
+        fields += [None] * (3 - len(fields))
+        songs.append(tuple(fields[:3]))
+    return songs
+  else:
+    kokfiles = sorted(glob.glob(source))
+
+  songs = []
+  for kokfile in kokfiles:
+    audiofile = None
+    stem = os.path.splitext(kokfile)[0]
+    for ext in (".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".wav"):
+      if isfile(stem + ext):
+        audiofile = stem + ext
+        break
+    songs.append((kokfile, audiofile, None))
+  return songs
+
+def readPlaylist(filename):
+  """
+    Read a playlist: one song per line as tab separated kok file and
+    optional audio file, relative to the playlist. Lines starting with
+    ">" are cards shown in between, given as text and the seconds to
+    show it, 5 by default, e.g. "> Up next:|Happy<TAB>4". Returns
+    ("song", kokfile, audiofile) and ("card", text, seconds) tuples.
+  """
+  entries = []
+  basedir = os.path.dirname(abspath(filename))
+  with open(filename) as f:
+    for lineno, line in enumerate(f, 1):
+      if line.strip() == "" or line.startswith("#"):
+        continue
+      fields = [field.strip() for field in line.rstrip("\n").split("\t")]
+      if fields[0].startswith(">"):
+        try:
+          seconds = float(fields[1]) if len(fields) > 1 and fields[1] else 5
+        except ValueError:
+          sys.exit("%s, line %d: Invalid number of seconds." % (filename, lineno))
+        entries.append(("card", fields[0][1:].strip(), seconds))
+        continue
+      audiofile = os.path.join(basedir, fields[1]) if len(fields) > 1 and fields[1] else None
+      entries.append(("song", os.path.join(basedir, fields[0]), audiofile))
+  return entries
+
+def runPlaylist(source, outfile, options):
+  """
+    Render all songs of a playlist into one movie, with a single ffmpeg
+    process encoding the frames as they come. Every song is parsed once
+    up front for its duration, then laid out only when the render gets
+    to it and dropped afterwards, so the memory doesn't grow with the
+    length of the playlist. The audio of every part, silence for the
+    cards and songs without audio, is cut or padded to the length of the
+    part and written to a FLAC file one after the other, which ffmpeg's
+    concat demuxer joins while encoding.
+  """
+  entries = readPlaylist(source)
+  if not entries:
+    sys.exit(source + ": No songs found.")
+  outfile = outfile or os.path.splitext(source)[0] + ".mp4"
+  if isfile(outfile) and not options["force"]:
+    sys.exit("File " + outfile + " already exists. Please remove, use --force or specify a different file using -o.")
+
+  def newApp(kokfile = None, audiofile = None):
+    return KaraOkay(kokfile, None, audiofile, options["fontfile"], True,
+      options["debug"], options["suppress_plug"], headless = True,
+      size = options["size"], fps = options["fps"], preview = options["preview"],
+      encoder = options["encoder"], compositor = options["compositor"])
+
+  # First pass: the number of frames and the audio of every part.
+  fps = newApp().fps
+  parts = []
+  # Removed when done, or on exit otherwise.
+  tmpdir = tempfile.TemporaryDirectory()
+  partfiles = []
+  for kind, value, extra in entries:
+    audiofile = None
+    if kind == "song":
+      if not isfile(value):
+        sys.exit(value + ": No such file or directory.")
+      app = newApp(value, extra)
+      audiofile = app.openAudio()
+      try:
+        app.parse(value)
+      except ParserError as e:
+        sys.exit(value + ": Parser error. Not a valid kok file. Error occurred in line: " + str(e))
+      if app.durationWarning():
+        print(app.durationWarning())
+      duration = app.duration
+    else:
+      duration = extra
+    # The same frames buildTimeline() comes up with.
+    frames = len(numpy.arange(0, duration, 1/fps))
+    parts.append((kind, value, audiofile, frames))
+
+    partfile = os.path.join(tmpdir.name, "part%05d.flac" % len(parts))
+    cmd = [ffmpegBinary(), "-y", "-loglevel", "error"]
+    if audiofile:
+      cmd += ["-i", audiofile]
+    else:
+      cmd += ["-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo"]
+    cmd += ["-vn", "-af", "aresample=44100,aformat=sample_fmts=s16:channel_layouts=stereo,apad,atrim=duration=%.6f" % (
+      frames / fps), "-c:a", "flac", partfile]
+    proc = subprocess.run(cmd, stderr = subprocess.PIPE)
+    if proc.returncode != 0:
+      sys.exit("Failed to prepare the audio of " + (audiofile or "a card") + ": " +
+        proc.stderr.decode(errors = "replace"))
+    partfiles.append(partfile)
+  listfile = os.path.join(tmpdir.name, "audio.txt")
+  with open(listfile, "w") as f:
+    for partfile in partfiles:
+      f.write("file '" + partfile + "'\n")
+  audioargs = ["-f", "concat", "-safe", "0", "-i", listfile,
+    "-map", "0:v", "-map", "1:a", "-c:a", "libmp3lame"]
+
+  # Second pass: render part after part into the one movie.
+  app = newApp()
+  encoder = app.encoder
+  writer = FFmpegWriter(outfile, (app.width, app.height), app.fps,
+    codec = encoder["codec"], preset = encoder["preset"], threads = encoder["threads"],
+    queuesize = encoder["queuesize"], crf = encoder["crf"], audioargs = audioargs)
+  started = time.time()
+  total = 0
+  try:
+    with writer:
+      for idx, (kind, value, audiofile, frames) in enumerate(parts):
+        app = newApp(value if kind == "song" else None, audiofile)
+        if kind == "song":
+          app.openAudio()
+          app.prepare()
+          for t in app.timeline["times"]:
+            writer.write_frame(app.render(t))
+          print("[%d/%d] %s: %d frames" % (idx + 1, len(parts), value, frames))
+        else:
+          app.setupScreen()
+          frame = app.titleCard(value)
+          for i in range(frames):
+            writer.write_frame(frame)
+          print("[%d/%d] Card \"%s\": %d frames" % (idx + 1, len(parts), value, frames))
+        total += frames
+        del app
+  except IOError as e:
+    sys.exit(str(e))
+  elapsed = time.time() - started
+  tmpdir.cleanup()
+  print("Rendered %d parts, %d frames in %.1f s, %.1f frames/s." % (
+    len(parts), total, elapsed, total / elapsed))
+
+def audioStamp(audiofile):
+  """
+    Size and modification time of the audio file, telling the catalog
+    that it was replaced. None if there's no audio file.
+  """
+  if not audiofile or not isfile(audiofile):
+    return None
+  stat = os.stat(audiofile)
+  return "%d:%r" % (stat.st_size, stat.st_mtime)
+
+def indexSong(job):
+  """
+    Parse a song for the catalog, in a worker. Returns the catalog row of
+    the song: its path, modification time, size, hash, duration, number
+    of cards and lines, the error if it's not valid, and the audio file
+    and its stamp.
+  """
+  kokfile, audiofile = job
+  stat = os.stat(kokfile)
+  app = KaraOkay(kokfile, None, audiofile, None, True, False, False, headless = True)
+  error = None
+  try:
+    app.openAudio()
+    app.parse(kokfile)
+  except ParserError as e:
+    error = "Line " + str(e)
+  except (SystemExit, IOError, UnicodeDecodeError) as e:
+    error = str(e)
+  lines = sum(len(card.lines) for card in app.cards)
+  return (kokfile, stat.st_mtime, stat.st_size, fileHash(kokfile),
+    None if error else app.duration, len(app.cards), lines, error, audiofile,
+    audioStamp(audiofile), time.time())
+
+class Catalog:
+  """
+    SQLite index of songs and the movies rendered from them. Songs are
+    only parsed again if their modification time or size changed, and
+    their hash along with them. A movie is stale if the song changed
+    since it was rendered, its audio file was replaced, or it was
+    rendered with other settings, see KaraOkay.renderKey().
+  """
+  version = 2
+  schema = """
+    CREATE TABLE IF NOT EXISTS songs (
+      path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT,
+      duration REAL, cards INTEGER, lines INTEGER, error TEXT,
+      audiofile TEXT, audio TEXT, indexed REAL);
+    CREATE TABLE IF NOT EXISTS renders (
+      path TEXT, outfile TEXT, fingerprint TEXT, hash TEXT, audiofile TEXT,
+      audio TEXT, rendered REAL, PRIMARY KEY (path, outfile));
+  """
+
+  def __init__(self, filename):
+    self.db = sqlite3.connect(filename)
+    # It's only an index, so one of an older version is built again.
+    if self.db.execute("PRAGMA user_version").fetchone()[0] != Catalog.version:
+      self.db.executescript("DROP TABLE IF EXISTS songs; DROP TABLE IF EXISTS renders;")
+      self.db.execute("PRAGMA user_version = %d" % Catalog.version)
+    self.db.executescript(Catalog.schema)
+
+  def close(self):
+    self.db.close()
+
+  def update(self, songs, jobs = 1):
+    """
+      Bring the index up to date with songs, (kokfile, audiofile, outfile)
+      tuples as found by findSongs(), parsing the new and changed ones in
+      jobs processes. Songs whose files are gone are removed, unless
+      they are still listed, which is recorded as their error. Prints
+      what changed.
+    """
+    started = time.time()
+    known = {row[0]: row[1:] for row in self.db.execute(
+      "SELECT path, mtime, size, hash, audiofile, audio FROM songs")}
+    listed = set()
+    changed = []
+    touched = []
+    missing = []
+    for kokfile, audiofile, outfile in songs:
+      kokfile = abspath(realpath(kokfile))
+      listed.add(kokfile)
+      row = known.get(kokfile)
+      try:
+        stat = os.stat(kokfile)
+      except OSError as e:
+        if not row or row[0] is not None:
+          missing.append((kokfile, None, None, None, None, 0, 0,
+            kokfile + ": " + e.strerror, audiofile, None, time.time()))
+        continue
+      if row and row[3:] == (audiofile, audioStamp(audiofile)):
+        if row[:2] == (stat.st_mtime, stat.st_size):
+          continue
+        # Touched, but not changed.
+        if row[2] == fileHash(kokfile):
+          touched.append((stat.st_mtime, stat.st_size, kokfile))
+          continue
+      changed.append((kokfile, audiofile))
+
+    if jobs > 1 and len(changed) > 1:
+      context = multiprocessing.get_context("spawn")
+      with context.Pool(jobs) as pool:
+        rows = pool.map(indexSong, changed, chunksize = max(1, len(changed) // (jobs * 4)))
+    else:
+      rows = [indexSong(job) for job in changed]
+    rows += missing
+
+    removed = [(path,) for path in known if path not in listed and not isfile(path)]
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+      self.db.executemany("UPDATE songs SET mtime = ?, size = ? WHERE path = ?", touched)
+      self.db.executemany("DELETE FROM songs WHERE path = ?", removed)
+      self.db.executemany("DELETE FROM renders WHERE path = ?", removed)
+    print("Indexed %d songs in %.1f s: %d new or changed, %d removed, %d with errors." % (
+      len(songs), time.time() - started, len(rows), len(removed),
+      sum(1 for row in rows if row[7])))
+
+  def stale(self, fingerprint):
+    """
+      The valid songs not rendered from their current version and audio
+      with the settings given by fingerprint, as (kokfile, audiofile,
+      hash, audio stamp).
+    """
+    return self.db.execute("""
+      SELECT songs.path, songs.audiofile, songs.hash, songs.audio FROM songs
+      WHERE songs.error IS NULL AND NOT EXISTS (
+        SELECT 1 FROM renders WHERE renders.path = songs.path
+          AND renders.hash = songs.hash AND renders.fingerprint = ?
+          AND renders.audiofile IS songs.audiofile AND renders.audio IS songs.audio)
+      ORDER BY songs.path""", (fingerprint,)).fetchall()
+
+  def outputs(self):
+    """
+      The movies rendered so far, as set of (kokfile, outfile).
+    """
+    return set(self.db.execute("SELECT path, outfile FROM renders").fetchall())
+
+  def songs(self):
+    return self.db.execute(
+      "SELECT path, duration, cards, lines, error FROM songs ORDER BY path").fetchall()
+
+  def errors(self):
+    return self.db.execute(
+      "SELECT path, error FROM songs WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+  def rendered(self, kokfile, outfile, fingerprint, hash, audiofile, audio):
+    with self.db:
+      self.db.execute("INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (abspath(realpath(kokfile)), outfile, fingerprint, hash, audiofile, audio, time.time()))
+
+def queryCatalog(filename, query, options):
+  """
+    Print the songs of the catalog, the ones which fail to parse or the
+    stale ones, which need to be rendered with options, tab separated.
+  """
+  catalog = Catalog(filename)
+  if query == "songs":
+    for path, duration, cards, lines, error in catalog.songs():
+      print("%s\t%s\t%s\t%s\t%s" % (path, "%.2f" % duration if duration is not None else "-",
+        cards, lines, error or "ok"))
+  elif query == "errors":
+    for path, error in catalog.errors():
+      print(path + "\t" + error)
+  else:
+    for path, audiofile, hash, audio in catalog.stale(optionsApp(options).renderKey()):
+      print(path)
+  catalog.close()
+
+def optionsApp(options, kokfile = None, audiofile = None, outfile = None):
+  """
+    A KaraOkay instance set up with batch options, to render a song or
+    for its keys.
+  """
+  return KaraOkay(kokfile, outfile, audiofile, options["fontfile"], options["force"],
+    options["debug"], options["suppress_plug"], options["vfr"], True,
+    cachedir = options["cachedir"], cachemax = options["cachemax"],
+    size = options["size"], fps = options["fps"],
+    preview = options["preview"], encoder = options["encoder"],
+    compositor = options["compositor"])
+
+# Queue the daemon's workers report their progress to.
+workerProgress = None
+
+def initBatchWorker(progress = None, moviepy = False):
+  """
+    Initializer of the batch worker processes. Everything set up here
+    and the fonts in KaraOkay.fonts stay around between the songs. The
+    daemon passes a queue to report the progress of its jobs to, and has
+    moviepy loaded up front if it's the backend.
+  """
+  global workerProgress
+  pygame.font.init()
+  workerProgress = progress
+  if moviepy:
+    from moviepy.video.VideoClip import VideoClip
+    from moviepy.audio.io.AudioFileClip import AudioFileClip
+
+def reportProgress(app, jobid, render):
+  """
+    Wrap render() of app, putting (jobid, frames done, frames) on the
+    progress queue about once per second of the movie.
+  """
+  done = 0
+  def reporting(t):
+    nonlocal done
+    frame = render(t)
+    done += 1
+    if done % app.fps == 0:
+      workerProgress.put((jobid, done, len(app.timeline["times"])))
+    return frame
+  return reporting
+
+def renderSong(job):
+  """
+    Render one song in a batch worker. Returns the kok file, whether it
+    succeeded, an error message, the number of frames and the time it
+    took.
+  """
+  options, (kokfile, audiofile, outfile) = job
+  started = time.time()
+  try:
+    app = optionsApp(options, kokfile, audiofile, outfile)
+    app.logger = None
+    if workerProgress is not None:
+      app.render = reportProgress(app, options["id"], app.render)
+    app.run()
+  except SystemExit as e:
+    return kokfile, False, str(e), 0, time.time() - started
+  except Exception as e:
+    return kokfile, False, type(e).__name__ + ": " + str(e), 0, time.time() - started
+  return kokfile, True, None, len(app.timeline["times"]), time.time() - started
+
+def runBatch(source, options, jobs, catalog = None):
+  """
+    Render all songs found in source using a pool of jobs worker
+    processes. With a catalog, it is updated first and only the songs
+    which are stale are rendered, and recorded there once done. Prints
+    the progress and a summary, returns the number of failed songs.
+  """
+  songs = findSongs(source)
+  if len(songs) == 0:
+    sys.exit(source + ": No songs found.")
+  if catalog:
+    catalog = Catalog(catalog)
+    catalog.update(songs, jobs)
+    fingerprint = optionsApp(options).renderKey()
+    stale = {path: (audiofile, hash, audio) for path, audiofile, hash, audio in catalog.stale(fingerprint)}
+    songs = [song for song in songs if abspath(realpath(song[0])) in stale]
+    print("%d songs to render." % len(songs))
+    if not songs:
+      catalog.close()
+      return 0
+
+  outfiles = {kokfile: outfile for kokfile, audiofile, outfile in songs}
+  tasks = [(options, song) for song in songs]
+  if catalog:
+    # Stale movies rendered before are ours to replace.
+    outputs = catalog.outputs()
+    tasks = [(dict(options, force = True) if (abspath(realpath(song[0])),
+      optionsApp(options, song[0], outfile = song[2]).movieFile()) in outputs else options, song)
+      for song in songs]
+  started = time.time()
+  failed = 0
+  frames = 0
+  context = multiprocessing.get_context("spawn")
+  with context.Pool(max(1, jobs), initializer = initBatchWorker) as pool:
+    done = 0
+    for kokfile, ok, error, songframes, elapsed in pool.imap_unordered(
+        renderSong, tasks):
+      done += 1
+      if ok:
+        frames += songframes
+        print("[%d/%d] %s: %d frames in %.1f s" % (done, len(songs), kokfile, songframes, elapsed))
+        if catalog:
+          outfile = outfiles[kokfile]
+          audiofile, hash, audio = stale[abspath(realpath(kokfile))]
+          catalog.rendered(kokfile, optionsApp(options, kokfile, outfile = outfile).movieFile(),
+            fingerprint, hash, audiofile, audio)
+      else:
+        failed += 1
+        print("[%d/%d] %s: failed: %s" % (done, len(songs), kokfile, error))
+
+  if catalog:
+    catalog.close()
+  elapsed = time.time() - started
+  print("Rendered %d of %d songs in %.1f s, %d failed. %.1f frames/s, %.1f songs/min." % (
+    len(songs) - failed, len(songs), elapsed, failed, frames / elapsed,
+    (len(songs) - failed) * 60 / elapsed))
+  return failed
+
+class RenderDaemon:
+  """
+    Renders songs submitted over a local HTTP API, using a pool of
+    worker processes which stay around between the jobs, so the imports,
+    pygame and the fonts are set up once. Jobs are run by priority,
+    highest first, in the order they came in otherwise.
+
+      POST /jobs                submit a job, see submit()
+      GET /jobs                 list all jobs
+      GET /jobs/ID              state and progress of a job
+      GET /jobs/ID/events       stream the state of a job as JSON lines,
+                                until it is done
+      DELETE /jobs/ID           cancel a queued job
+
+    The kok files and movies go to directory. The kok files are removed
+    once the job is over.
+  """
+  # Seconds finished jobs are kept around for their state to be asked.
+  keep = 3600
+
+  # The options a job may override, with a check of their value.
+  overrides = {
+    "fps": lambda value: type(value) is int and value > 0,
+    "preview": lambda value: type(value) is bool,
+    "suppress_plug": lambda value: type(value) is bool,
+    "vfr": lambda value: type(value) is bool,
+    "compositor": lambda value: value in ("pygame", "numpy"),
+    "backend": lambda value: value in ("moviepy", "ffmpeg"),
+    "codec": lambda value: isinstance(value, str) and re.match(r"^\w+$", value),
+    "preset": lambda value: isinstance(value, str) and re.match(r"^\w+$", value),
+    "crf": lambda value: type(value) is int and value >= 0,
+    "threads": lambda value: type(value) is int and value >= 0,
+    "queuesize": lambda value: type(value) is int and value > 0
+  }
+
+  def __init__(self, directory, options, jobs):
+    self.directory = abspath(directory)
+    self.options = options
+    self.workers = max(1, jobs)
+    self.jobs = OrderedDict()
+    self.queue = queue.PriorityQueue()
+    self.slots = threading.Semaphore(self.workers)
+    self.changed = threading.Condition()
+    self.seq = 0
+
+  def serve(self, port):
+    os.makedirs(self.directory, exist_ok = True)
+    context = multiprocessing.get_context("spawn")
+    self.progress = context.Queue()
+    self.pool = context.Pool(self.workers, initializer = initBatchWorker,
+      initargs = (self.progress, self.options["encoder"]["backend"] in (None, "moviepy")))
+    for target in (self.dispatch, self.collect):
+      threading.Thread(target = target, daemon = True).start()
+
+    import http.server
+    handler = type("Handler", (DaemonHandler, http.server.BaseHTTPRequestHandler), {"daemon": self})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    print("Serving on http://127.0.0.1:%d, %d workers, writing to %s" % (
+      server.server_address[1], self.workers, self.directory))
+    # Shut down on SIGTERM as on Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      self.pool.terminate()
+
+  def submit(self, request):
+    """
+      Queue a job given as dict: "kok" is the text of the kok file,
+      "audio" the path of the audio file, "outfile" the file name of the
+      movie in the daemon's directory, "priority" a number and "options"
+      overrides the daemon's options: size and those in overrides. All
+      but "kok" are optional. Returns the job, raises ValueError if the
+      request is invalid.
+    """
+    if not isinstance(request, dict) or not isinstance(request.get("kok"), str):
+      raise ValueError("The text of the kok file must be given as kok.")
+    if not isinstance(request.get("options", {}), dict):
+      raise ValueError("The options must be given as object.")
+    options = dict(self.options, encoder = dict(self.options["encoder"]), force = True)
+    for key, value in request.get("options", {}).items():
+      if key == "size":
+        try:
+          options["size"] = parseSize(str(value))
+        except argparse.ArgumentTypeError as e:
+          raise ValueError(str(e))
+        continue
+      if key not in self.overrides:
+        raise ValueError("Unknown option " + key)
+      if not self.overrides[key](value):
+        raise ValueError("Invalid value of option " + key)
+      if key in options["encoder"]:
+        options["encoder"][key] = value
+      else:
+        options[key] = value
+    audiofile = request.get("audio")
+    if audiofile is not None and not isinstance(audiofile, str):
+      raise ValueError("The audio file must be given as path.")
+    if audiofile and not isfile(audiofile):
+      raise ValueError(audiofile + ": No such file or directory.")
+    # Jobs overwrite their movie, so it has to stay in the directory.
+    outfile = request.get("outfile")
+    if outfile is not None and (not isinstance(outfile, str) or
+        os.path.basename(outfile) != outfile or outfile.startswith(".") or
+        os.path.splitext(outfile)[1] not in (".mp4", ".mkv", ".mov", ".webm")):
+      raise ValueError("The movie must be given as file name ending in .mp4, .mkv, .mov or .webm.")
+    try:
+      priority = int(request.get("priority", 0))
+    except (TypeError, ValueError):
+      raise ValueError("The priority must be a number.")
+
+    jobid = os.urandom(6).hex()
+    kokfile = os.path.join(self.directory, jobid + ".kok")
+    with open(kokfile, "w", encoding = "utf-8") as f:
+      f.write(request["kok"])
+    options["id"] = jobid
+    job = {
+      "id": jobid,
+      "state": "queued",
+      "priority": priority,
+      "kokfile": kokfile,
+      "audiofile": audiofile,
+      "outfile": os.path.join(self.directory, outfile or jobid + ".mp4"),
+      "frames": 0,
+      "done": 0,
+      "error": None,
+      "submitted": time.time(),
+      "finished": None,
+      "elapsed": None
+    }
+    with self.changed:
+      self.expire()
+      self.jobs[jobid] = job
+      self.seq += 1
+      self.queue.put((-priority, self.seq, jobid, options))
+    return job
+
+  def cancel(self, jobid):
+    """
+      Cancel a queued job. Returns False if it already started.
+    """
+    with self.changed:
+      job = self.jobs[jobid]
+      if job["state"] != "queued":
+        return False
+      job["state"] = "cancelled"
+      job["finished"] = time.time()
+      self.changed.notify_all()
+    os.remove(job["kokfile"])
+    return True
+
+  def dispatch(self):
+    # Hand the jobs to the pool one by one as workers become free, so
+    # the priorities of jobs submitted meanwhile count.
+    while True:
+      self.slots.acquire()
+      priority, seq, jobid, options = self.queue.get()
+      with self.changed:
+        job = self.jobs[jobid]
+        if job["state"] != "queued":
+          self.slots.release()
+          continue
+        job["state"] = "running"
+        self.changed.notify_all()
+      song = (job["kokfile"], job["audiofile"], job["outfile"])
+      self.pool.apply_async(renderSong, ((options, song),),
+        callback = lambda result, jobid = jobid: self.finished(jobid, result),
+        error_callback = lambda e, jobid = jobid: self.finished(jobid,
+          (None, False, type(e).__name__ + ": " + str(e), 0, None)))
+
+  def finished(self, jobid, result):
+    kokfile, ok, error, frames, elapsed = result
+    with self.changed:
+      job = self.jobs[jobid]
+      job["state"] = "done" if ok else "failed"
+      job["error"] = error
+      job["finished"] = time.time()
+      job["elapsed"] = elapsed
+      if ok:
+        job["frames"] = job["done"] = frames
+      self.changed.notify_all()
+    os.remove(job["kokfile"])
+    self.slots.release()
+
+  def expire(self):
+    # Forget jobs finished more than self.keep seconds ago. Called with
+    # self.changed held.
+    limit = time.time() - self.keep
+    for jobid in [jobid for jobid, job in self.jobs.items()
+        if job["finished"] is not None and job["finished"] < limit]:
+      del self.jobs[jobid]
+
+  def collect(self):
+    # Progress reported by the workers.
+    while True:
+      jobid, done, frames = self.progress.get()
+      with self.changed:
+        job = self.jobs.get(jobid)
+        if job and job["state"] == "running":
+          job["done"], job["frames"] = done, frames
+          self.changed.notify_all()
+
+  def status(self, job):
+    status = dict(job)
+    status["progress"] = job["done"] / job["frames"] if job["frames"] else 0
+    return status
+
+class DaemonHandler:
+  """
+    The HTTP API of RenderDaemon, which is set as daemon. Mixed into
+    http.server's BaseHTTPRequestHandler by RenderDaemon.serve().
+  """
+  daemon = None
+
+  def send(self, code, body):
+    data = (json.dumps(body) + "\n").encode()
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def job(self):
+    # The job addressed by the path, and what's after its id.
+    parts = self.path.strip("/").split("/")
+    with self.daemon.changed:
+      job = self.daemon.jobs.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+    if job is None:
+      self.send(404, {"error": "No such job"})
+      return None, None
+    return job, parts[2:]
+
+  def do_POST(self):
+    if self.path.rstrip("/") != "/jobs":
+      return self.send(404, {"error": "Not found"})
+    # Keeps out the simple requests a web page may send without asking.
+    if self.headers.get_content_type() != "application/json":
+      return self.send(415, {"error": "Jobs must be sent as application/json"})
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+      request = json.loads(self.rfile.read(length).decode("utf-8"))
+      job = self.daemon.submit(request)
+    except (ValueError, UnicodeDecodeError) as e:
+      return self.send(400, {"error": str(e)})
+    self.send(201, self.daemon.status(job))
+
+  def do_GET(self):
+    if self.path.rstrip("/") == "/jobs":
+      with self.daemon.changed:
+        return self.send(200, [self.daemon.status(job) for job in self.daemon.jobs.values()])
+    job, rest = self.job()
+    if job is None:
+      return
+    if rest == ["events"]:
+      return self.events(job)
+    if rest:
+      return self.send(404, {"error": "Not found"})
+    with self.daemon.changed:
+      self.send(200, self.daemon.status(job))
+
+  def do_DELETE(self):
+    job, rest = self.job()
+    if job is None:
+      return
+    if not self.daemon.cancel(job["id"]):
+      return self.send(409, {"error": "Job already " + job["state"]})
+    self.send(200, self.daemon.status(job))
+
+  def events(self, job):
+    # Stream the state as a JSON line whenever it changes, until the job
+    # is done. The end of the response is marked by closing the
+    # connection.
+    self.send_response(200)
+    self.send_header("Content-Type", "application/x-ndjson")
+    self.end_headers()
+    last = None
+    while True:
+      with self.daemon.changed:
+        status = self.daemon.status(job)
+        if status == last:
+          self.daemon.changed.wait(10)
+          continue
+      try:
+        self.wfile.write((json.dumps(status) + "\n").encode())
+        self.wfile.flush()
+      except OSError:
+        return
+      last = status
+      if status["state"] not in ("queued", "running"):
+        return
+
+  def log_message(self, format, *args):
+    pass
+
 if __name__ == "__main__":  
   parser = argparse.ArgumentParser(description='Produce an okay karaoke movie from a text file. See README.md.')
-  parser.add_argument("filename", help = "Input file to process. May be ending with .kok.")
+  parser.add_argument("filename", nargs = "?", help = "Input file to process. May be ending with .kok. In batch and catalog mode a directory, a glob pattern or a manifest file.")
   parser.add_argument("-o", "--outfile", dest = "outfile", help = "Name of the movie file. it should end in .mp4. If none given, a filename is guessed from the input file.")
   parser.add_argument("-a", "--audiofile", dest = "audiofile", help = "Path to the audio file to play in the movie. If none given, the movie remains silent.")
-  parser.add_argument("-f", "--fontfile", dest = "fontfile", help = "Path to a font file usable by pygame. Defaults to ./fonts/SourceSansPro-Semibold.ttf")
+  parser.add_argument("-f", "--fontfile", dest = "fontfile", help = "Path to a font file usable by pygame. Defaults to fonts/SourceSansPro-Semibold.ttf next to this script.")
   parser.add_argument("--force", action = "store_true", help = "If set, an existing movie may be overriden.")
   parser.add_argument("--debug", action = "store_true", help = "If set, the current time is rendered on every frame and the text with timings is printed to stdout.")
   parser.add_argument("--suppress-plug", action = "store_true", help = "If set, the plug after the last slide will not be shown.")
+  parser.add_argument("--vfr", action = "store_true", help = "If set, frames which don't change are written as variable frame rate video, so the encoder only handles them once.")
+  parser.add_argument("--headless", action = "store_true", help = "If set, the movie is rendered offscreen without opening a window. No display is needed.")
+  parser.add_argument("-j", "--jobs", type = int, default = 1, help = "Number of processes rendering segments of the movie in parallel, or songs in batch mode. Defaults to 1.")
+  parser.add_argument("--cache-dir", dest = "cachedir", help = "Directory to keep encoded segments and the compiled layout of the movie in. Rendering the movie again only renders the parts which changed.")
+  parser.add_argument("--cache-max", dest = "cachemax", type = float, help = "Size in MB the cache directory is kept below, removing the least recently used segments and layouts after rendering. Defaults to no limit.")
+  parser.add_argument("--layout", dest = "layoutfile", help = "File to keep the compiled layout of the song in. It's loaded instead of parsing and laying out the song again, if the file, font and settings are still the same, and written otherwise.")
+  parser.add_argument("--size", type = parseSize, help = "Size of the movie in pixels, given as WIDTHxHEIGHT. Defaults to 1280x720.")
+  parser.add_argument("--fps", type = int, help = "Frames per second. Defaults to 30.")
+  parser.add_argument("--preview", action = "store_true", help = "If set, a small and fast to render preview is produced, at 640x360 and 10 frames per second unless given otherwise. The movie name defaults to the input file name ending in .preview.mp4.")
+  parser.add_argument("--validate", nargs = "?", const = "text", choices = ["text", "json"], help = "Only check the file and print the timings of its lines as --debug does, or as JSON with --validate json. No movie is rendered.")
+  parser.add_argument("--renditions", type = parseRenditions, help = "Encode the movie in several sizes at once, e.g. 1920x1080,1280x720,640x360:libx265. The frames are rendered once at the largest size and scaled by ffmpeg. The movies are named after the height, e.g. happy.720p.mp4.")
+  parser.add_argument("--live", choices = ["window", "null", "pipe", "socket"], help = "Play the lyrics in real time instead of writing a movie: in a window (with the audio), as raw rgb24 frames to a pipe or socket for a streaming process, or nowhere (null), e.g. to test the timing. Late frames are dropped.")
+  parser.add_argument("--live-target", dest = "livetarget", help = "With --live pipe, the file or FIFO to write the frames to, stdout by default. With --live socket, HOST:PORT, PORT on localhost or the path of a Unix socket to connect to.")
+  parser.add_argument("--playlist", action = "store_true", help = "If set, filename is a playlist of songs, with optional cards in between, rendered into a single movie. See README.md.")
+  parser.add_argument("--catalog", help = "SQLite file indexing the songs found as in batch mode: their hash, duration, number of cards and lines, errors and the movies rendered from them. Updated incrementally using -j processes. With --batch, only songs with stale movies are rendered.")
+  parser.add_argument("--query", choices = ["songs", "errors", "stale"], help = "Print all songs of the --catalog, the ones which fail to parse, or the ones whose movies are stale with the given settings. Doesn't update the catalog, no filename needed.")
+  parser.add_argument("--serve", type = int, metavar = "PORT", help = "Run as daemon, rendering jobs submitted over HTTP on localhost:PORT with -j warm worker processes. filename is the directory to write the kok files and movies to. See README.md.")
+  parser.add_argument("--batch", action = "store_true", help = "If set, render all songs of a directory, glob pattern or tab separated manifest file (kok file, audio file, movie file). Audio files next to the kok files with the same name are picked up.")
+  parser.add_argument("--backend", choices = ["moviepy", "ffmpeg"], help = "Write the movie using moviepy (default) or by piping the frames straight into ffmpeg, encoding while the next frames are rendered.")
+  parser.add_argument("--codec", help = "Video codec used by ffmpeg. Defaults to libx264.")
+  parser.add_argument("--preset", help = "Encoder preset, e.g. ultrafast or slow. Defaults to medium, ultrafast for previews.")
+  parser.add_argument("--crf", type = int, help = "Constant rate factor of the encoder. Lower means better quality.")
+  parser.add_argument("--threads", type = int, help = "Number of threads used by the encoder.")
+  parser.add_argument("--queue-size", dest = "queuesize", type = int, help = "Number of frames buffered for the ffmpeg backend. Defaults to 8.")
+  parser.add_argument("--ass", dest = "assfile", help = "Write the lyrics with their timing as ASS subtitles with karaoke tags to the given file. Without --subtitles, no movie is rendered.")
+  parser.add_argument("--subtitles", choices = ["burn", "soft"], help = "Let ffmpeg render the movie from ASS subtitles instead of drawing every frame: burn them into the picture, or add them as subtitle track (use a .mkv movie to keep the highlighting).")
+  parser.add_argument("--compositor", choices = ["pygame", "numpy"], default = "pygame", help = "Draw the frames using pygame (default), or compose them from pre-rendered lines using numpy, which is faster. Both give the same pixels. --debug always uses pygame.")
+  parser.add_argument("--profile", help = "Write a JSON report of the time spent per stage, render time per frame, font renders, frame copies and encoder waits to the given file.")
+  parser.add_argument("--profile-dump", help = "With --profile, also write cProfile stats of rendering the movie to the given file, to be read with pstats.")
   args = parser.parse_args()
+  if args.query and not args.catalog:
+    parser.error("--query needs a --catalog.")
+  if args.filename is None and not args.query:
+    parser.error("the following arguments are required: filename")
+  if args.renditions and args.vfr:
+    parser.error("--renditions can't be combined with --vfr.")
+
+  encoder = {
+    "backend": args.backend,
+    "codec": args.codec,
+    "preset": args.preset,
+    "crf": args.crf,
+    "threads": args.threads,
+    "queuesize": args.queuesize
+  }
+
+  if args.batch or args.serve is not None or args.playlist or args.catalog:
+    options = {
+      "fontfile": args.fontfile,
+      "force": args.force,
+      "debug": args.debug,
+      "suppress_plug": args.suppress_plug,
+      "vfr": args.vfr,
+      "cachedir": args.cachedir,
+      "cachemax": args.cachemax,
+      "size": args.size,
+      "fps": args.fps,
+      "preview": args.preview,
+      "compositor": args.compositor,
+      "encoder": encoder
+    }
+    if args.query:
+      queryCatalog(args.catalog, args.query, options)
+      sys.exit(0)
+    if args.catalog and not args.batch:
+      catalog = Catalog(args.catalog)
+      catalog.update(findSongs(args.filename), args.jobs)
+      catalog.close()
+      sys.exit(0)
+    if args.playlist:
+      runPlaylist(args.filename, args.outfile, options)
+      sys.exit(0)
+    if args.serve is not None:
+      RenderDaemon(args.filename, options, args.jobs).serve(args.serve)
+      sys.exit(0)
+    sys.exit(1 if runBatch(args.filename, options, args.jobs, args.catalog) else 0)
 
-  app = KaraOkay(args.filename, args.outfile, args.audiofile, args.fontfile, args.force, args.debug, args.suppress_plug)
-  app.run()  
+  # Only the window sink shows anything.
+  headless = args.headless or (args.live is not None and args.live != "window")
+  app = KaraOkay(args.filename, args.outfile, args.audiofile, args.fontfile, args.force, args.debug, args.suppress_plug, args.vfr, headless, args.jobs, args.cachedir, args.size, args.fps, args.preview, encoder, args.assfile, args.subtitles, args.layoutfile, compositor = args.compositor, profile = args.profile, profiledump = args.profile_dump, live = args.live, livetarget = args.livetarget, renditions = args.renditions, cachemax = args.cachemax)
+  if args.validate:
+    app.validate(args.validate)
+  else:
+    app.run()  
 
 
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import sys, random, json, time, argparse, tempfile, subprocess, platform
+import pygame, numpy
+from KaraOkay import KaraOkay, ffmpegBinary, parseRenditions
+
+vocabulary = ("I want to be happy but won't til made you too life's really worth "
+  "living when we are mirth giving why can't give some to love me tender "
+  "sweet never let go all my dreams fulfilled darling so true").split()
+
+# Synthetic songs. duration in seconds, cardLength in seconds, lines per
+# card, intra is the share of words getting a timestamp, pauses the share
+# of cards with a pause before them and words the words per line.
+scenarios = {
+  "short": {"duration": 60},
+  "song": {"duration": 240},
+  "dense": {"duration": 240, "lines": 6, "intra": 1.0},
+  "pauses": {"duration": 240, "pauses": 0.5},
+  "long-lines": {"duration": 240, "words": 14},
+  "medley": {"duration": 1800}
+}
+
+def timestamp(seconds):
+  return "%d:%05.2f" % (seconds // 60, seconds % 60)
+
+def generateKok(filename, duration = 180, cardLength = 8, lines = 4, intra = 0.3,
+    pauses = 0.1, words = 6, seed = 1):
+  """
+    Write a synthetic kok file filling duration seconds with cards. The
+    lines of a card share its time evenly, intra line timestamps are
+    placed in between the words they precede. Returns the number of
+    cards written.
+  """
+  rand = random.Random(seed)
+  out = ["# Duration: " + timestamp(duration)]
+  t = 1.0
+  cards = 0
+  while True:
+    # Pause bars are shown for gaps longer than KaraOkay.pause_threshold
+    t += 5 if rand.random() < pauses else 0.5
+    start, end = round(t, 2), round(t + cardLength, 2)
+    if end > duration - 1:
+      break
+    out.append("-- %s - %s" % (timestamp(start), timestamp(end)))
+    for line in range(lines):
+      first = start + (end - start) * line / lines
+      length = (end - start) / lines
+      text = []
+      for word in range(words):
+        token = rand.choice(vocabulary)
+        if word > 0 and rand.random() < intra:
+          secs = min(max(int((first + length * word / words) * 100) / 100, start), end)
+          token = "[" + timestamp(secs) + "]" + token
+        text.append(token)
+      out.append(" ".join(text))
+    t = end
+    cards += 1
+  with open(filename, "w") as f:
+    f.write("\n".join(out) + "\n")
+  return cards
+
+def silence(filename, duration):
+  """
+    Write a silent mp3 of duration seconds, generated by ffmpeg.
+  """
+  cmd = [ffmpegBinary(), "-y", "-loglevel", "error", "-f", "lavfi", "-i",
+    "anullsrc=r=44100:cl=stereo", "-t", str(duration), "-c:a", "libmp3lame", filename]
+  subprocess.run(cmd, check = True)
+
+def timed(function, timings, name):
+  """
+    Wrap function, adding the time spent in it to timings[name].
+  """
+  def wrapper(*args, **kwargs):
+    started = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      timings[name] = timings.get(name, 0) + time.perf_counter() - started
+  return wrapper
+
+def newApp(kokfile, options, compositor = "pygame", size = None, codec = None, renditions = None):
+  return KaraOkay(kokfile, None, None, None, True, False, False, headless = True,
+    size = size or options.size, fps = options.fps,
+    encoder = {"backend": "ffmpeg", "preset": options.preset, "codec": codec},
+    compositor = compositor, renditions = renditions)
+
+def runScenario(name, params, options, tmpdir):
+  """
+    Time parse, layout and render of one synthetic song and the
+    throughput of encoding part of it. Returns the metrics, times in ms.
+  """
+  kokfile = os.path.join(tmpdir, name + ".kok")
+  cards = generateKok(kokfile, seed = options.seed, **params)
+  result = {"cards": cards}
+
+  # Best of options.repeat runs, on a fresh instance every time.
+  best = {}
+  for i in range(options.repeat):
+    app = newApp(kokfile, options)
+    timings = {}
+    app.layoutlines = timed(app.layoutlines, timings, "layoutlines")
+    app.buildTimeline = timed(app.buildTimeline, timings, "timeline")
+    started = time.perf_counter()
+    app.parse(kokfile)
+    timings["parse"] = time.perf_counter() - started
+    started = time.perf_counter()
+    app.layout()
+    timings["layout"] = time.perf_counter() - started
+    for key, value in timings.items():
+      best[key] = min(best.get(key, value), value)
+  for key, value in best.items():
+    result[key + "_ms"] = value * 1000
+  result["lines"] = len(app.lines)
+  result["frames"] = len(app.timeline["times"])
+
+  # Windows of consecutive frames spread over the song, rendered in
+  # order as when encoding, once to warm up the caches and once timed.
+  # The first frame of a fresh instance is timed on its own.
+  for compositor in options.compositors:
+    app = newApp(kokfile, options, compositor)
+    app.prepare()
+    times = app.timeline["times"]
+    started = time.perf_counter()
+    app.render(times[0])
+    result["render_%s_cold_ms" % compositor] = (time.perf_counter() - started) * 1000
+    window = min(options.window, len(times))
+    windows = max(1, options.samples // window)
+    durations = []
+    for first in numpy.linspace(0, len(times) - window, windows).astype(int):
+      for t in times[first:first + window]:
+        app.render(t)
+      for t in times[first:first + window]:
+        started = time.perf_counter()
+        app.render(t)
+        durations.append(time.perf_counter() - started)
+    durations = numpy.array(durations) * 1000
+    result["render_%s_ms" % compositor] = float(durations.mean())
+    result["render_%s_p95_ms" % compositor] = float(numpy.percentile(durations, 95))
+
+  # End to end: the first encodeSeconds of the movie with silent audio,
+  # through the ffmpeg backend.
+  if options.encode_seconds > 0:
+    app = newApp(kokfile, options, options.compositors[0])
+    app.prepare()
+    last = min(len(app.timeline["times"]), int(options.encode_seconds * app.fps))
+    audiofile = os.path.join(tmpdir, name + ".mp3")
+    silence(audiofile, last / app.fps)
+    started = time.perf_counter()
+    app.writeFrames(os.path.join(tmpdir, name + ".mp4"), 0, last, audiofile)
+    result["encode_fps"] = last / (time.perf_counter() - started)
+
+    # All renditions in one pass against a run per rendition, both
+    # including parse and layout.
+    if options.renditions:
+      started = time.perf_counter()
+      app = newApp(kokfile, options, options.compositors[0], renditions = options.renditions)
+      app.prepare()
+      app.writeFrames(os.path.join(tmpdir, name + ".mp4"), 0, last, audiofile)
+      result["renditions_ms"] = (time.perf_counter() - started) * 1000
+      started = time.perf_counter()
+      for width, height, codec in options.renditions:
+        app = newApp(kokfile, options, options.compositors[0], size = (width, height), codec = codec)
+        app.prepare()
+        app.writeFrames(os.path.join(tmpdir, "%s.%dp.mp4" % (name, height)), 0, last, audiofile)
+      result["renditions_separate_ms"] = (time.perf_counter() - started) * 1000
+      result["renditions_speedup"] = result["renditions_separate_ms"] / result["renditions_ms"]
+
+  return result
+
+def compare(results, baseline, threshold, thresholds):
+  """
+    Compare results against the baseline. Metrics ending in _ms may get
+    slower and those ending in _fps may drop by the threshold, given as
+    fraction, before they count as regression. Returns the regressions
+    as (scenario, metric, baseline, result) tuples.
+  """
+  regressions = []
+  for name, metrics in results["scenarios"].items():
+    base = baseline.get("scenarios", {}).get(name, {})
+    for metric, value in metrics.items():
+      if metric not in base:
+        continue
+      allowed = thresholds.get(metric, threshold)
+      if metric.endswith("_ms") and value > base[metric] * (1 + allowed):
+        regressions.append((name, metric, base[metric], value))
+      if metric.endswith("_fps") and value < base[metric] * (1 - allowed):
+        regressions.append((name, metric, base[metric], value))
+  return regressions
+
+def parseThreshold(value):
+  metric, sep, fraction = value.partition("=")
+  try:
+    return metric, float(fraction)
+  except ValueError:
+    raise argparse.ArgumentTypeError("Threshold must be given as METRIC=FRACTION, e.g. layout_ms=0.25.")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Benchmark KaraOkay on synthetic songs.")
+  parser.add_argument("scenarios", nargs = "*", help = "Scenarios to run: " + ", ".join(scenarios) + ". Defaults to all of them.")
+  parser.add_argument("-o", "--output", help = "Write the results as JSON to this file.")
+  parser.add_argument("--baseline", help = "JSON results of an earlier run to compare against. Exits with 1 on regressions.")
+  parser.add_argument("--threshold", type = float, default = 0.1, help = "Allowed slowdown before a metric counts as regression, as fraction. Defaults to 0.1.")
+  parser.add_argument("--metric-threshold", dest = "thresholds", type = parseThreshold, action = "append", default = [], help = "Threshold of a single metric, e.g. encode_fps=0.2. May be given more than once.")
+  parser.add_argument("--repeat", type = int, default = 3, help = "Runs of parse and layout, the best one counts. Defaults to 3.")
+  parser.add_argument("--samples", type = int, default = 300, help = "Number of frames timed per compositor. Defaults to 300.")
+  parser.add_argument("--window", type = int, default = 30, help = "Number of consecutive frames timed in a row, after rendering them once to warm up. Defaults to 30.")
+  parser.add_argument("--encode-seconds", type = float, default = 10, help = "Seconds of the movie to encode for the throughput. 0 to skip. Defaults to 10.")
+  parser.add_argument("--compositors", type = lambda value: value.split(","), default = ["pygame", "numpy"], help = "Comma separated compositors to render with. The first one is used for encoding. Defaults to pygame,numpy.")
+  parser.add_argument("--size", type = lambda value: tuple(map(int, value.split("x"))), default = (1280, 720), help = "Size of the movie, WIDTHxHEIGHT. Defaults to 1280x720.")
+  parser.add_argument("--fps", type = int, default = 30, help = "Frames per second. Defaults to 30.")
+  parser.add_argument("--preset", default = "ultrafast", help = "Encoder preset. Defaults to ultrafast.")
+  parser.add_argument("--renditions", type = lambda value: [] if value == "none" else parseRenditions(value), help = "Renditions to time encoding in one pass and one by one, e.g. 1920x1080,1280x720,640x360. Defaults to the size and half of it, none to skip.")
+  parser.add_argument("--seed", type = int, default = 1, help = "Seed of the song generator. Defaults to 1.")
+  args = parser.parse_args()
+  if args.renditions is None:
+    width, height = args.size
+    args.renditions = [(width, height, None), (width // 4 * 2, height // 4 * 2, None)]
+
+  for name in args.scenarios:
+    if name not in scenarios:
+      sys.exit(name + ": No such scenario.")
+
+  results = {
+    "environment": {
+      "python": platform.python_version(),
+      "pygame": pygame.version.ver,
+      "numpy": numpy.__version__,
+      "platform": platform.platform(),
+      "cpus": os.cpu_count()
+    },
+    "settings": {
+      "size": args.size, "fps": args.fps, "preset": args.preset, "seed": args.seed,
+      "repeat": args.repeat, "samples": args.samples, "window": args.window,
+      "encode_seconds": args.encode_seconds,
+      "renditions": args.renditions
+    },
+    "scenarios": {}
+  }
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for name in args.scenarios or scenarios:
+      result = runScenario(name, scenarios[name], args, tmpdir)
+      results["scenarios"][name] = result
+      print("%-10s %s" % (name, ", ".join("%s %.3g" % (key, value) for key, value in result.items())))
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent = 2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold, dict(args.thresholds))
+    for name, metric, base, value in regressions:
+      print("Regression in %s: %s went from %.3g to %.3g" % (name, metric, base, value))
+    if regressions:
+      sys.exit(1)
+    print("No regressions against " + args.baseline)